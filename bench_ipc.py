@@ -0,0 +1,45 @@
+import time
+import timeit
+import tracemalloc
+
+from ipc_handler import PeerRecord, ChatEvent
+
+# Vergleicht Speicherbedarf und Attributzugriff der __slots__-Klassen PeerRecord/ChatEvent
+# mit den früher verwendeten Dictionaries. Aufruf: python bench_ipc.py [anzahl_peers] [anzahl_events]
+
+
+# Misst den mit tracemalloc belegten Speicher für n erzeugte Objekte in MiB
+def measure(make, n: int) -> float:
+    tracemalloc.start()
+    objects = [make(i) for i in range(n)]
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del objects
+    return current / 2**20
+
+
+def main(peers: int = 10_000, events: int = 1_000_000):
+    now = time.time()
+
+    peer_dict = measure(lambda i: {'ip': '10.0.0.1', 'tcp_port': 5000 + i, 'status': 'online',
+                                   'last_seen': now + i, 'visible': True}, peers)
+    peer_record = measure(lambda i: PeerRecord('10.0.0.1', 5000 + i, 'online', now + i), peers)
+    print(f"{peers} Peers:    dict {peer_dict:8.2f} MiB   PeerRecord {peer_record:8.2f} MiB")
+
+    event_dict = measure(lambda i: {'type': 'text', 'sender_ip': '10.0.0.1', 'content': 'hi',
+                                    'timestamp': now + i}, events)
+    event_record = measure(lambda i: ChatEvent('text', 'hi', sender_ip='10.0.0.1', timestamp=now + i), events)
+    print(f"{events} Events: dict {event_dict:8.1f} MiB   ChatEvent  {event_record:8.1f} MiB")
+
+    # Attributzugriff pro Lookup in Nanosekunden
+    d = {'ip': '10.0.0.1', 'tcp_port': 5000}
+    r = PeerRecord('10.0.0.1', 5000)
+    number = 2_000_000
+    dict_ns = timeit.timeit(lambda: d['tcp_port'], number=number) / number * 1e9
+    slots_ns = timeit.timeit(lambda: r.tcp_port, number=number) / number * 1e9
+    print(f"Lookup:          dict {dict_ns:8.1f} ns    __slots__  {slots_ns:8.1f} ns")
+
+
+if __name__ == "__main__":
+    import sys
+    main(*(int(arg) for arg in sys.argv[1:3]))
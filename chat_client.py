@@ -1,6 +1,141 @@
 import socket
 import os
-from typing import Dict, Any
+import errno
+import select
+import threading
+import time
+import math
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import Dict, Any, Callable, List, Tuple
+
+
+class ConnectionPool:
+    # Hält pro Peer (ip, tcp_port) aufgebaute TCP-Verbindungen offen,
+    # damit nicht jede Nachricht einen eigenen Verbindungsauf- und -abbau braucht
+    def __init__(self, timeout: float, idle_timeout: float = 20, max_per_peer: int = 2, max_lifetime: float = 60):
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout # Sekunden, nach denen eine ungenutzte Verbindung geschlossen wird
+        self.max_per_peer = max_per_peer # Maximale Anzahl offener Verbindungen pro Peer im Pool
+        self.max_lifetime = max_lifetime # Sekunden, nach denen eine Verbindung auch bei Nutzung neu aufgebaut wird
+        self.lock = threading.Lock()
+        self.idle = {} # (ip, port) -> Liste von (socket, Zeitpunkt der letzten Nutzung, Zeitpunkt des Aufbaus)
+
+    # Prüft, ob eine ruhende Verbindung von der Gegenseite geschlossen wurde.
+    # Eine ungenutzte Verbindung sollte nie lesbar sein - ist sie es doch,
+    # steht dort ein EOF (oder unerwartete Daten) und sie wird verworfen.
+    @staticmethod
+    def is_dropped(sock: socket.socket) -> bool:
+        try:
+            readable, _, _ = select.select([sock], [], [], 0)
+        except (OSError, ValueError):
+            return True
+        return bool(readable)
+
+    @staticmethod
+    def close_socket(sock: socket.socket):
+        try:
+            sock.close()
+        except OSError:
+            pass
+
+    # Baut eine neue Verbindung auf. Ein verschwundener Host (WLAN weg, Standby) schickt kein FIN -
+    # ohne diese Optionen würde sendall() weiter in den Kernel-Puffer schreiben und Erfolg melden.
+    # Keepalive erkennt den toten Host im Leerlauf, TCP_USER_TIMEOUT (Linux) bricht die Verbindung ab,
+    # sobald gesendete Daten länger als timeout unbestätigt bleiben. Die nächste Nutzung schlägt dann fehl.
+    def connect(self, ip: str, port: int, timeout: float) -> socket.socket:
+        sock = socket.create_connection((ip, port), timeout=timeout)
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            for name, value in (("TCP_KEEPIDLE", 5), ("TCP_KEEPINTVL", 2), ("TCP_KEEPCNT", 3)):
+                if hasattr(socket, name):
+                    sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, name), value)
+            if hasattr(socket, "TCP_USER_TIMEOUT"):
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_USER_TIMEOUT, int(self.timeout * 1000))
+        except OSError:
+            pass # Optionen sind eine Verbesserung, keine Voraussetzung
+        return sock
+
+    # Liefert eine Verbindung zum Peer: bevorzugt eine ruhende aus dem Pool, sonst eine neue.
+    # Rückgabe: (socket, wiederverwendet?, Zeitpunkt des Verbindungsaufbaus)
+    def acquire(self, ip: str, port: int, timeout: float = None) -> Tuple[socket.socket, bool, float]:
+        timeout = timeout or self.timeout
+        now = time.monotonic()
+        with self.lock:
+            conns = self.idle.get((ip, port), [])
+            while conns:
+                sock, last_used, created = conns.pop()
+                if (now - last_used < self.idle_timeout and now - created < self.max_lifetime
+                        and not self.is_dropped(sock)):
+                    sock.settimeout(timeout)
+                    return sock, True, created
+                self.close_socket(sock)
+
+        return self.connect(ip, port, timeout), False, now
+
+    # Gibt eine Verbindung nach erfolgreicher Nutzung an den Pool zurück
+    def release(self, ip: str, port: int, sock: socket.socket, created: float):
+        with self.lock:
+            self.prune()
+            conns = self.idle.setdefault((ip, port), [])
+            if len(conns) < self.max_per_peer and time.monotonic() - created < self.max_lifetime:
+                conns.append((sock, time.monotonic(), created))
+                return
+        self.close_socket(sock) # Limit pro Peer erreicht oder Verbindung zu alt
+
+    # Schließt alle Verbindungen, deren Leerlaufzeit abgelaufen ist (Aufruf nur mit self.lock)
+    def prune(self):
+        now = time.monotonic()
+        for key in list(self.idle):
+            alive = []
+            for sock, last_used, created in self.idle[key]:
+                if now - last_used < self.idle_timeout and now - created < self.max_lifetime:
+                    alive.append((sock, last_used, created))
+                else:
+                    self.close_socket(sock)
+            if alive:
+                self.idle[key] = alive
+            else:
+                del self.idle[key]
+
+    # Führt func(sock) auf einer Verbindung zum Peer aus.
+    # Bricht eine wiederverwendete Verbindung dabei ab (z.B. Broken Pipe),
+    # wird genau einmal mit einer frischen Verbindung neu versucht.
+    # Mit keep=False wird die Verbindung danach geschlossen statt in den Pool zurückgegeben.
+    def run(self, ip: str, port: int, func: Callable[[socket.socket], Any], timeout: float = None, keep: bool = True):
+        sock, reused, created = self.acquire(ip, port, timeout)
+        try:
+            result = func(sock)
+        except OSError as e:
+            # ETIMEDOUT vom Kernel: TCP_USER_TIMEOUT/Keepalive hat die Verbindung zu einem verschwundenen Host
+            # abgebrochen (anders als ein einfacher socket.timeout, der errno None hat)
+            broken = isinstance(e, (BrokenPipeError, ConnectionResetError, ConnectionAbortedError)) or e.errno == errno.ETIMEDOUT
+            self.close_socket(sock)
+            if not (reused and broken):
+                raise
+            sock = self.connect(ip, port, timeout or self.timeout)
+            created = time.monotonic()
+            try:
+                result = func(sock)
+            except Exception:
+                self.close_socket(sock)
+                raise
+        except Exception:
+            self.close_socket(sock)
+            raise
+
+        if keep:
+            self.release(ip, port, sock, created)
+        else:
+            self.close_socket(sock)
+        return result
+
+    # Schließt alle Verbindungen im Pool (z.B. beim Beenden)
+    def close_all(self):
+        with self.lock:
+            for conns in self.idle.values():
+                for sock, _, _ in conns:
+                    self.close_socket(sock)
+            self.idle.clear()
 
 
 class ChatClient:
@@ -9,6 +144,20 @@ class ChatClient:
         self.config = config
         self.username = username
 
+        # Verbindungspool für persistente TCP-Verbindungen zu den Peers
+        network = self.config.get('network', {})
+        self.pool = ConnectionPool(
+            timeout=self.config['system']['socket_timeout'],
+            idle_timeout=network.get('pool_idle_timeout', 20),
+            max_per_peer=network.get('max_connections_per_peer', 2),
+            max_lifetime=network.get('pool_max_lifetime', 60)
+        )
+
+        # Begrenzter Thread-Pool, über den Broadcasts parallel an alle Peers verschickt werden
+        self.fanout_workers = network.get('fanout_workers', 16)
+        self.send_deadline = network.get('send_deadline', 3)
+        self.executor = ThreadPoolExecutor(max_workers=self.fanout_workers, thread_name_prefix="fanout")
+
     # Sendet eine SLCP-Nachricht über TCP
     def send_text_message(self, target_ip: str, target_port: int, target_handle: str, message: str) -> bool:
         try:
@@ -21,15 +170,40 @@ class ChatClient:
                 print(f"Nachricht zu lang ({len(encoded)} Bytes). Maximal erlaubt: 512 Bytes.")
                 return False
 
-            
-            with socket.create_connection((target_ip, target_port), timeout=self.config['system']['socket_timeout']) as sock:
-                sock.sendall(encoded) # Sende die SLCP-Nachricht
+            # Sende die SLCP-Nachricht über eine (wiederverwendete) Verbindung aus dem Pool
+            self.pool.run(target_ip, target_port, lambda sock: sock.sendall(encoded))
             return True
         #Error-Handling
         except Exception as e:
             print(f"Text Message Error: {e}")
             return False
 
+    # Sendet mehrere SLCP-Nachrichten an denselben Peer in einem einzigen sendall
+    # messages: Liste von (target_handle, message). Der Server liest die Zeilen
+    # nacheinander von derselben Verbindung (Pipelining), z.B. beim Nachsenden
+    # einer ganzen Warteschlange.
+    def send_batch(self, target_ip: str, target_port: int, messages: List[Tuple[str, str]]) -> bool:
+        if not messages:
+            return True
+        try:
+            frames = []
+            for target_handle, message in messages:
+                encoded = f"MSG {target_handle} {message}\n".encode("utf-8")
+
+                # Jede einzelne Nachricht darf maximal 512 Bytes lang sein
+                if len(encoded) > 512:
+                    print(f"Nachricht zu lang ({len(encoded)} Bytes). Maximal erlaubt: 512 Bytes.")
+                    return False
+                frames.append(encoded)
+
+            payload = b"".join(frames)
+            self.pool.run(target_ip, target_port, lambda sock: sock.sendall(payload))
+            return True
+        #Error-Handling
+        except Exception as e:
+            print(f"Batch Message Error: {e}")
+            return False
+
     # Sendet eine SLCP-Bildnachricht über TCP
     def send_image_message(self, target_ip: str, target_port: int, target_handle: str, image_path: str) -> bool:
         """Sendet eine SLCP-Bildnachricht über TCP"""
@@ -46,19 +220,74 @@ class ChatClient:
                 print(f"Bild zu groß: {file_size} bytes (max: {max_size})")
                 return False
 
-            slcp_header = f"IMG {target_handle} {file_size}\n"
+            slcp_header = f"IMG {target_handle} {file_size}\n".encode("utf-8")
 
-            with open(image_path, "rb") as f:
-                image_data = f.read()
+            # MSG_MORE (nur Linux) hält den Header zurück, bis die ersten Bilddaten folgen,
+            # damit beide gemeinsam im selben TCP-Segment verschickt werden
+            more_flag = getattr(socket, "MSG_MORE", 0)
 
-            # Stellt eine TCP-Verbindung zum Zielnutzer her und überträgt zuerst den SLCP-Header, dann die Bilddaten.
-            with socket.create_connection((target_ip, target_port), timeout=self.config['system']['socket_timeout']) as sock:
-                sock.sendall(slcp_header.encode("utf-8"))
-                sock.sendall(image_data)
+            # Überträgt über eine Verbindung aus dem Pool zuerst den SLCP-Header, dann die Bilddaten.
+            # Die Datei wird nicht komplett eingelesen: socket.sendfile() nutzt os.sendfile
+            # (Kopie direkt im Kernel) und fällt sonst auf blockweises Senden zurück.
+            with open(image_path, "rb") as f:
+                def send_image(sock: socket.socket):
+                    sock.sendall(slcp_header, more_flag)
+                    sent = sock.sendfile(f, 0, file_size)
+                    if sent != file_size:
+                        # Datei wurde während des Sendens verändert, der Empfänger wartet sonst ewig
+                        raise OSError(f"Nur {sent} von {file_size} Bytes gesendet")
 
+                # Danach schließen: lehnt der Empfänger das Bild ab, sollen spätere Nachrichten
+                # nicht über eine Verbindung laufen, die er gerade schließt
+                self.pool.run(target_ip, target_port, send_image, keep=False)
             return True
         #Error-Handling
         except Exception as e:
             print(f"Image Message Error: {e}")
             return False
 
+    # Sendet eine Textnachricht parallel an mehrere Empfänger
+    # recipients: handle -> PeerRecord (wie von IPCHandler.get_snapshot().users geliefert)
+    # Jeder einzelne Versand hat send_deadline Sekunden Zeit, ein toter Peer blockiert
+    # die anderen also nicht. Rückgabe: handle -> "ok", "failed", "timeout" oder "invalid" (zu lang)
+    def send_text_to_many(self, recipients: Dict[str, Any], message: str) -> Dict[str, str]:
+        if not recipients:
+            return {}
+
+        # Versand an einen einzelnen Peer mit eigener Frist (send_deadline)
+        def send_one(handle: str, info) -> str:
+            encoded = f"MSG {handle} {message}\n".encode("utf-8")
+            if len(encoded) > 512:
+                print(f"Nachricht zu lang ({len(encoded)} Bytes). Maximal erlaubt: 512 Bytes.")
+                return "invalid"
+            try:
+                self.pool.run(info.ip, info.tcp_port, lambda sock: sock.sendall(encoded), timeout=self.send_deadline)
+                return "ok"
+            except socket.timeout:
+                return "timeout"
+            except Exception as e:
+                print(f"Text Message Error ({handle}): {e}")
+                return "failed"
+
+        futures = {self.executor.submit(send_one, handle, info): handle for handle, info in recipients.items()}
+
+        # Bei mehr Empfängern als Worker-Threads laufen die Sendungen in mehreren Wellen
+        waves = math.ceil(len(futures) / self.fanout_workers)
+        _, not_done = wait(futures, timeout=self.send_deadline * waves + 1)
+
+        # Der Pool wird auch von anderen genutzt (PeerCache, parallele GUI-Sendungen) - noch nicht
+        # gestartete Sendungen werden abgebrochen und gelten als "timeout". Bereits laufende können
+        # nicht mehr abgebrochen werden: auf sie wird gewartet (jede ist durch ihren Socket-Timeout
+        # begrenzt), sonst würden sie später zustellen und die OutboundQueue sendet ein zweites Mal.
+        cancelled = {future for future in not_done if future.cancel()}
+        wait(not_done - cancelled)
+
+        report = {}
+        for future, handle in futures.items():
+            report[handle] = "timeout" if future in cancelled else future.result()
+        return report
+
+    # Schließt alle offenen Verbindungen des Pools
+    def close(self):
+        self.executor.shutdown(wait=False)
+        self.pool.close_all()
@@ -1,10 +1,62 @@
+import asyncio
 import socket
 import threading
 import time
 import os
 import subprocess
 import platform
-from typing import Dict, Any
+import tempfile
+from typing import Dict, Any, Optional
+
+from ipc_handler import ChatEvent
+
+
+# Blockgröße beim Empfang von Bildern - begrenzt den Speicherbedarf pro Übertragung
+IMAGE_CHUNK_SIZE = 16 * 1024
+
+
+class ImagePart:
+    # Temporäre Datei für ein gerade empfangenes Bild, gemeinsam genutzt vom threaded und vom asyncio-Server.
+    # Die Blöcke werden in eine .part-Datei im Bildordner geschrieben; finish() benennt sie erst nach
+    # vollständigem Empfang atomar um. Verlässt man den with-Block vorher (Abbruch, Fehler), wird sie gelöscht.
+    def __init__(self, folder: str):
+        self.folder = folder
+        fd, self.tmp_path = tempfile.mkstemp(prefix=".received_", suffix=".part", dir=folder)
+        self.file = os.fdopen(fd, "wb")
+        self.ext = ".bin"
+        self.received = 0
+        self.filepath = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+    # Schließt die Datei und entfernt sie, wenn finish() nicht erreicht wurde
+    def close(self):
+        self.file.close()
+        if self.filepath is None:
+            try:
+                os.remove(self.tmp_path)
+            except OSError:
+                pass
+
+    # Schreibt einen Block; das Format wird am ersten Block erkannt
+    def write(self, chunk: bytes):
+        if self.received == 0:
+            self.ext = ChatServer.detect_image_extension(chunk)
+        self.file.write(chunk)
+        self.received += len(chunk)
+
+    # Schließt die Datei und verschiebt sie unter einem freien Namen in den Bildordner
+    def finish(self) -> str:
+        self.file.close()
+        filepath = ChatServer.unique_image_path(self.folder, self.ext)
+        os.replace(self.tmp_path, filepath)
+        self.filepath = filepath
+        return filepath
 
 
 class ChatServer:
@@ -72,111 +124,28 @@ class ChatServer:
                     print(f"Verbindungsfehler: {e}")
 
     # Verarbeitet eingehende Nachrichten von Clients
+    # Die Verbindung bleibt offen, bis der Client sie schließt oder sie
+    # länger als connection_idle_timeout Sekunden ungenutzt ist, damit
+    # der ChatClient sie für weitere Nachrichten wiederverwenden kann
     def handle_client(self, client_socket: socket.socket, addr):
+        idle_timeout = self.config['network'].get('connection_idle_timeout', 30)
         try:
+            client_socket.settimeout(idle_timeout)
             with client_socket.makefile("rb") as sockfile:
-                line = sockfile.readline().decode("utf-8", errors="ignore").strip()
-                parts = line.split(" ", 2)
-                cmd = parts[0].upper()
-
-                # Normale Text Nachrichten
-                if cmd == "MSG" and len(parts) >= 3:
-                    recipient = parts[1]
-                    message = parts[2]
-                    display_msg = {
-                        'type': 'text',
-                        'sender_ip': addr[0],
-                        'content': message,
-                        'timestamp': time.time()
-                    }
-                    self.ipc_handler.send_message(display_msg)
-
-                # Image Nachrichten
-                elif cmd == "IMG" and len(parts) == 3:
-                    recipient = parts[1]
-                    try:
-                        size = int(parts[2])
-
-                    #Error-Handling für ungültige Bildgrößen
-                    except ValueError:
-                        print(f"Ungültige Bildgröße: {parts[2]}")
-                        return
-
-                    image_data = sockfile.read(size)
-
-                    folder = self.config.get("system", {}).get("imagepath", "images")
-                    os.makedirs(folder, exist_ok=True)
-
-                    ext = ".bin"
-                    #Verschiedene Dateiendungen für verschiedene Bildformate
-                    if image_data.startswith(b"\x89PNG\r\n\x1a\n"):
-                        ext = ".png"
-                    elif image_data.startswith(b"\xff\xd8"):
-                        ext = ".jpg"
-                    elif image_data.startswith(b"GIF87a") or image_data.startswith(b"GIF89a"):
-                        ext = ".gif"
-
-                    # Generiere einen Dateinamen mit Zeitstempel
-                    # und speichere das Bild im angegebenen Ordner
-                    filename = f"received_{int(time.time())}{ext}"
-                    filepath = os.path.join(folder, filename) #
-                    with open(filepath, "wb") as f:
-                        f.write(image_data) # Speichert die Bilddaten in der Datei
-
-                    #Inhalt der Nachricht für die Anzeige
-                    display_msg = {
-                        'type': 'image',
-                        'sender_ip': addr[0],
-                        'filename': filepath,
-                        'timestamp': time.time()
-                    }
-                    self.ipc_handler.send_message(display_msg) # sendet die Nachricht an den IPC-Handler
-
-                    # Bild automatisch öffnen (optional)
-                    if self.config.get("system", {}).get("image_autoview", True):
-                        try:
-                            if platform.system() == "Linux":
-                                subprocess.Popen(["xdg-open", filepath])
-                            elif platform.system() == "Darwin":
-                                subprocess.Popen(["open", filepath])
-                            elif platform.system() == "Windows":
-                                os.startfile(filepath)
-                        except Exception as e:
-                            print(f"[Bildanzeige] Fehler beim Öffnen: {e}")
-
-                # Leave System Nachrichten
-                elif cmd == "LEAVE" and len(parts) == 2:
-                    handle = parts[1]
-
-                    # Entferne den Benutzer aus der Benutzerliste
-                    self.ipc_handler.remove_user_by_name(handle)
-
-                    #Inhalt der Nachricht für die Anzeige
-                    display_msg = {
-                        'type': 'system',
-                        'content': f"{handle} hat den Chat verlassen.", # handle ist hier der Benutzer der den Chat verlässt
-                        'timestamp': time.time()
-                    }
-
-                    #Nachricht an IPC-Handler senden
-                    self.ipc_handler.send_message(display_msg)
-
-                # Known Users System Nachrichten
-                elif cmd == "KNOWUSERS":
-                    entries = line[10:].split(",") # Teile die KNOWUSERS-Nachricht in ihre Bestandteile auf
-
-                    for entry in entries:
-                        entry_parts = entry.strip().split(" ")
-
-                        # Prüfe, ob die Einträge die erwartete Struktur haben
-                        if len(entry_parts) == 3:
-                            handle, ip, port = entry_parts
-
-                            if handle != self.config.get("handle"):
-                                # Aktualisiere die Benutzerliste im IPC-Handler
-                                # wenn alles in Ordnung ist
-                                self.ipc_handler.update_user_list(handle, ip, int(port), time.time())
+                while self.running:
+                    raw = sockfile.readline()
+                    if not raw:
+                        break # Client hat die Verbindung geschlossen
+
+                    line = raw.decode("utf-8", errors="ignore").strip()
+                    if not line:
+                        continue
+                    if not self.handle_line(line, sockfile, addr):
+                        break
 
+        # Verbindung war zu lange ungenutzt
+        except socket.timeout:
+            pass
         #Error Handling
         except Exception as e:
             print(f"Fehler bei Nachricht: {e}")
@@ -184,3 +153,308 @@ class ChatServer:
         # Schließe den Client-Socket, wenn die Verarbeitung abgeschlossen ist
         finally:
             client_socket.close()
+
+    # Verarbeitet eine einzelne SLCP-Zeile einer Verbindung
+    # Gibt False zurück, wenn die Verbindung danach nicht weiter gelesen werden kann
+    def handle_line(self, line: str, sockfile, addr) -> bool:
+        parts = line.split(" ", 2)
+        cmd = parts[0].upper()
+
+        # Normale Text Nachrichten
+        if cmd == "MSG" and len(parts) >= 3:
+            recipient = parts[1]
+            message = parts[2]
+            display_msg = ChatEvent('text', message, sender_ip=addr[0])
+            self.ipc_handler.send_message(display_msg)
+
+        # Image Nachrichten
+        elif cmd == "IMG" and len(parts) == 3:
+            recipient = parts[1]
+            try:
+                size = int(parts[2])
+
+            #Error-Handling für ungültige Bildgrößen
+            except ValueError:
+                print(f"Ungültige Bildgröße: {parts[2]}")
+                return False # Länge der Bilddaten unbekannt, Verbindung nicht mehr lesbar
+
+            # Bild blockweise in eine temporäre Datei empfangen
+            filepath = self.receive_image(sockfile, size)
+            if filepath is None:
+                # Bild abgelehnt - die Bilddaten überlesen, damit die nächste Zeile wieder am Anfang steht
+                return self.discard_image(sockfile, size)
+
+            self.publish_image(filepath, addr)
+
+        # Leave System Nachrichten
+        elif cmd == "LEAVE" and len(parts) == 2:
+            handle = parts[1]
+
+            # Entferne den Benutzer aus der Benutzerliste
+            self.ipc_handler.remove_user_by_name(handle)
+
+            #Inhalt der Nachricht für die Anzeige
+            display_msg = ChatEvent('system', f"{handle} hat den Chat verlassen.") # handle ist hier der Benutzer der den Chat verlässt
+
+            #Nachricht an IPC-Handler senden
+            self.ipc_handler.send_message(display_msg)
+
+        # Known Users System Nachrichten
+        elif cmd == "KNOWUSERS":
+            entries = line[10:].split(",") # Teile die KNOWUSERS-Nachricht in ihre Bestandteile auf
+            updates = []
+
+            for entry in entries:
+                entry_parts = entry.strip().split(" ")
+
+                # Prüfe, ob die Einträge die erwartete Struktur haben
+                if len(entry_parts) == 3:
+                    handle, ip, port = entry_parts
+
+                    if handle != self.config.get("handle"):
+                        # Aktualisiere die Benutzerliste im IPC-Handler
+                        # wenn alles in Ordnung ist (gesammelt, ein Snapshot für die ganze Zeile)
+                        updates.append((handle, ip, int(port)))
+
+            self.ipc_handler.update_users(updates, time.time())
+
+        return True
+
+    # Ordner für empfangene Bilder (wird bei Bedarf angelegt)
+    def image_folder(self) -> str:
+        folder = self.config.get("system", {}).get("imagepath", "images")
+        os.makedirs(folder, exist_ok=True)
+        return folder
+
+    # Bestimmt die Dateiendung anhand der ersten Bytes (Magic Bytes) des Bildes
+    @staticmethod
+    def detect_image_extension(head: bytes) -> str:
+        #Verschiedene Dateiendungen für verschiedene Bildformate
+        if head.startswith(b"\x89PNG\r\n\x1a\n"):
+            return ".png"
+        elif head.startswith(b"\xff\xd8"):
+            return ".jpg"
+        elif head.startswith(b"GIF87a") or head.startswith(b"GIF89a"):
+            return ".gif"
+        return ".bin"
+
+    # Generiere einen Dateinamen mit Zeitstempel, der im Ordner noch nicht existiert.
+    # Der Name wird mit O_CREAT|O_EXCL als leere Datei reserviert, damit zwei gleichzeitig
+    # empfangene Bilder nicht denselben Namen bekommen; os.replace ersetzt die Datei danach.
+    @staticmethod
+    def unique_image_path(folder: str, ext: str) -> str:
+        stamp = int(time.time())
+        filepath = os.path.join(folder, f"received_{stamp}{ext}")
+        counter = 1
+        while True:
+            try:
+                os.close(os.open(filepath, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644))
+                return filepath
+            except FileExistsError:
+                filepath = os.path.join(folder, f"received_{stamp}_{counter}{ext}")
+                counter += 1
+
+    # Prüft die angekündigte Bildgröße gegen max_image_size
+    def image_size_allowed(self, size: int) -> bool:
+        max_size = self.config.get("user", {}).get("max_image_size", 5242880)
+        if size < 0 or size > max_size:
+            print(f"Bild abgelehnt: {size} Bytes angekündigt (max: {max_size})")
+            return False
+        return True
+
+    # Zu große Bilder werden bis max_image_discard Bytes gelesen und verworfen, damit die Verbindung
+    # weiter benutzt werden kann. Noch größere (oder negative) Angaben: Verbindung schließen.
+    def image_discard_allowed(self, size: int) -> bool:
+        max_discard = self.config.get("user", {}).get("max_image_discard", 20971520)
+        return 0 <= size <= max_discard
+
+    # Liest size Bytes abgelehnter Bilddaten blockweise und verwirft sie
+    # Gibt False zurück, wenn die Verbindung danach nicht weiter gelesen werden kann
+    def discard_image(self, sockfile, size: int) -> bool:
+        if not self.image_discard_allowed(size):
+            return False
+        remaining = size
+        while remaining > 0:
+            chunk = sockfile.read(min(IMAGE_CHUNK_SIZE, remaining))
+            if not chunk:
+                return False
+            remaining -= len(chunk)
+        return True
+
+    # Empfängt size Bytes Bilddaten blockweise in eine temporäre Datei im Bildordner
+    # und benennt sie erst nach vollständigem Empfang atomar um.
+    # Gibt den Pfad des gespeicherten Bildes zurück oder None, wenn die Größe nicht erlaubt ist.
+    def receive_image(self, sockfile, size: int) -> Optional[str]:
+        if not self.image_size_allowed(size):
+            return None
+
+        with ImagePart(self.image_folder()) as part:
+            while part.received < size:
+                chunk = sockfile.read(min(IMAGE_CHUNK_SIZE, size - part.received))
+                if not chunk:
+                    raise ConnectionError(f"Verbindung nach {part.received} von {size} Bytes abgebrochen")
+                part.write(chunk)
+            return part.finish()
+
+    # Meldet ein empfangenes Bild an den IPC-Handler und öffnet es optional
+    def publish_image(self, filepath: str, addr):
+        #Inhalt der Nachricht für die Anzeige
+        display_msg = ChatEvent('image', sender_ip=addr[0], filename=filepath)
+        self.ipc_handler.send_message(display_msg) # sendet die Nachricht an den IPC-Handler
+
+        # Bild automatisch öffnen (optional)
+        if self.config.get("system", {}).get("image_autoview", True):
+            try:
+                if platform.system() == "Linux":
+                    subprocess.Popen(["xdg-open", filepath])
+                elif platform.system() == "Darwin":
+                    subprocess.Popen(["open", filepath])
+                elif platform.system() == "Windows":
+                    os.startfile(filepath)
+            except Exception as e:
+                print(f"[Bildanzeige] Fehler beim Öffnen: {e}")
+
+
+class AsyncChatServer(ChatServer):
+    # Alternative zum ChatServer: alle Verbindungen laufen als Coroutinen in einer
+    # einzigen asyncio-Eventloop (eigener Thread) statt in je einem eigenen Thread.
+    # Nachrichtenverarbeitung und Bildspeicherung werden vom ChatServer übernommen,
+    # der IPC-Handler ist über Queue und Lock bereits threadsicher.
+    def __init__(self, config: Dict[str, Any], ipc_handler):
+        super().__init__(config, ipc_handler)
+        self.loop = None
+        self.server = None
+        self.ready = threading.Event() # wird gesetzt, sobald der Port feststeht
+
+    # Start Funktion des Servers
+    # Blockiert, bis der Server lauscht, damit chat_port danach in der Config steht
+    def start(self):
+        self.running = True
+        self.ready.clear()
+        threading.Thread(target=self.run_loop, daemon=True).start()
+        self.ready.wait(5)
+
+    # Stoppt die Eventloop sofort (kein Warten auf einen Accept-Timeout)
+    def stop(self):
+        self.running = False
+        if self.loop and self.loop.is_running():
+            self.loop.call_soon_threadsafe(self.loop.stop)
+
+    # Läuft im eigenen Thread: öffnet den Server und betreibt die Eventloop
+    def run_loop(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+        try:
+            self.loop.run_until_complete(self.open_server())
+        #Error-Handling
+        except Exception as e:
+            print(f"Fehler beim Serverstart: {e}")
+            self.running = False
+            self.ready.set()
+            self.loop.close()
+            return
+
+        self.ready.set()
+        try:
+            self.loop.run_forever()
+        finally:
+            # Offene Verbindungen abbrechen und Loop aufräumen
+            self.server.close()
+            tasks = asyncio.all_tasks(self.loop)
+            for task in tasks:
+                task.cancel()
+            self.loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+            self.loop.close()
+
+    # Startet den Server auf dem konfigurierten Port oder - falls belegt - auf einem freien Port
+    async def open_server(self):
+        configured_port = self.config['network'].get('chat_port', 0)
+        try:
+            self.server = await asyncio.start_server(self.handle_connection, '', configured_port, reuse_address=True)
+
+        #Error-Handling für den Fall, dass der Port bereits belegt ist
+        except OSError:
+            configured_port = self.get_free_tcp_port()
+            self.server = await asyncio.start_server(self.handle_connection, '', configured_port, reuse_address=True)
+
+        self.config['network']['chat_port'] = configured_port
+        print(f"[Server] Lauscht auf TCP-Port {configured_port} (asyncio)") # Ausgabe für Benutzer
+
+    # Verarbeitet eine Verbindung - wie ChatServer.handle_client, aber als Coroutine
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        addr = writer.get_extra_info("peername")
+        idle_timeout = self.config['network'].get('connection_idle_timeout', 30)
+        try:
+            while self.running:
+                raw = await asyncio.wait_for(reader.readline(), idle_timeout)
+                if not raw:
+                    break # Client hat die Verbindung geschlossen
+
+                line = raw.decode("utf-8", errors="ignore").strip()
+                if not line:
+                    continue
+
+                parts = line.split(" ", 2)
+                if parts[0].upper() == "IMG" and len(parts) == 3:
+                    keep_open = await self.handle_image(parts, reader, addr)
+                else:
+                    keep_open = self.handle_line(line, None, addr) # MSG, LEAVE, KNOWUSERS
+                if not keep_open:
+                    break
+
+        # Verbindung war zu lange ungenutzt oder der Server wird beendet
+        except (asyncio.TimeoutError, asyncio.CancelledError):
+            pass
+        #Error Handling
+        except Exception as e:
+            print(f"Fehler bei Nachricht: {e}")
+        finally:
+            writer.close()
+
+    # IMG-Nachricht: Bilddaten blockweise aus dem Stream in eine temporäre Datei lesen
+    async def handle_image(self, parts, reader: asyncio.StreamReader, addr) -> bool:
+        try:
+            size = int(parts[2])
+        #Error-Handling für ungültige Bildgrößen
+        except ValueError:
+            print(f"Ungültige Bildgröße: {parts[2]}")
+            return False
+
+        if not self.image_size_allowed(size):
+            # Bilddaten überlesen, damit die nächste Zeile wieder am Anfang steht (siehe discard_image)
+            if not self.image_discard_allowed(size):
+                return False
+            remaining = size
+            while remaining > 0:
+                chunk = await reader.read(min(IMAGE_CHUNK_SIZE, remaining))
+                if not chunk:
+                    return False
+                remaining -= len(chunk)
+            return True
+
+        # Dateizugriffe (anlegen, schreiben, umbenennen) und das Öffnen des Bildbetrachters blockieren -
+        # sie laufen im Thread-Pool der Eventloop, damit die anderen Verbindungen weiterbedient werden
+        loop = asyncio.get_running_loop()
+        part = await loop.run_in_executor(None, lambda: ImagePart(self.image_folder()))
+        try:
+            while part.received < size:
+                chunk = await reader.read(min(IMAGE_CHUNK_SIZE, size - part.received))
+                if not chunk:
+                    raise ConnectionError(f"Verbindung nach {part.received} von {size} Bytes abgebrochen")
+                await loop.run_in_executor(None, part.write, chunk)
+            filepath = await loop.run_in_executor(None, part.finish)
+        finally:
+            await loop.run_in_executor(None, part.close)
+
+        await loop.run_in_executor(None, self.publish_image, filepath, addr)
+        return True
+
+
+# Erstellt den Chat-Server passend zu server_mode aus der config.toml
+# "threaded" (Standard): ein Thread pro Verbindung, "asyncio": eine Eventloop für alle Verbindungen
+def create_chat_server(config: Dict[str, Any], ipc_handler) -> ChatServer:
+    mode = config.get('network', {}).get('server_mode', 'threaded')
+    if mode == 'asyncio':
+        return AsyncChatServer(config, ipc_handler)
+    return ChatServer(config, ipc_handler)
@@ -6,13 +6,16 @@ import toml
 from typing import Dict, Any
 import socket
 
+from ipc_handler import ChatEvent, PeerRecord
+
 
 class CLI:
-    def __init__(self, config: Dict[str, Any], ipc_handler, chat_client, discovery_service):
+    def __init__(self, config: Dict[str, Any], ipc_handler, chat_client, discovery_service, outbound_queue):
         self.config = config
         self.ipc_handler = ipc_handler
         self.chat_client = chat_client
         self.discovery_service = discovery_service
+        self.outbound_queue = outbound_queue
         self.running = False
         self.last_input_time = time.time()
         self.inactivity_timeout = 60
@@ -141,14 +144,18 @@ class CLI:
 
             # Wenn /who aufgerufen wird
             elif cmd == "who":
+                # Auf die Antworten warten, statt fest 2 s zu schlafen: fertig, sobald sich die Nutzerliste
+                # geändert hat und kurz ruhig bleibt. Kommt nichts (Liste schon aktuell), höchstens bis
+                # alle verzögerten Antworten (reply_jitter) da sein müssten.
+                version = self.ipc_handler.get_version()
                 self.discovery_service.request_discovery()
-                time.sleep(2)
+                self.ipc_handler.wait_for_change(version, timeout=self.discovery_service.reply_jitter + 0.5)
                 self.show_active_users()
 
             # Wenn /msg aufgerufen wird
             elif cmd == "msg":
                 if len(parts) >= 2:
-                    self.discovery_service.request_discovery()
+                    self.discovery_service.refresh_membership() # Nutzerliste ggf. im Hintergrund auffrischen
                     self.send_broadcast_message(" ".join(parts[1:]))
                 else:
                     print("Verwendung: /msg <nachricht>")
@@ -260,13 +267,11 @@ class CLI:
         # Den eigenen Nutzer manuell eintragen
         own_name = self.chat_client.username
         if own_name and own_name not in users:
-            users[own_name] = {
-            "ip": self.chat_client.config["network"].get("local_ip", "127.0.0.1"),
-            "tcp_port": self.chat_client.config["network"].get("chat_port", 5001),
-            "status": "online",
-            "last_seen": time.time(),
-            "visible": True
-        }
+            users[own_name] = PeerRecord(
+                self.chat_client.config["network"].get("local_ip", "127.0.0.1"),
+                self.chat_client.config["network"].get("chat_port", 5001),
+                last_seen=time.time()
+            )
 
         # Wenn keine Nutzer bekannt sind, wird eine entsprechende Nachricht ausgegeben
         if not users:
@@ -276,7 +281,8 @@ class CLI:
         # Wenn Nutzer bekannt sind, werden sie aufgelistet
         print("Aktive Nutzer:")
         for name, info in users.items():
-            print(f"  {name} @ {info['ip']}:{info['tcp_port']}")
+            status = "" if info.status == "online" else f" ({info.status})"
+            print(f"  {name} @ {info.ip}:{info.tcp_port}{status}")
 
     # Sendet eine Broadcast-Nachricht an alle aktiven Nutzer
     def send_broadcast_message(self, message: str):
@@ -287,17 +293,24 @@ class CLI:
             print("Bitte zuerst mit /join <name> beitreten.")
             return
         
-        users = self.ipc_handler.get_active_users()
+        # Dieselben Peers wie in der Nutzerliste: sichtbar und mit gültiger Lease
+        users = self.ipc_handler.get_active_users(only_visible=True)
         if not users:
             print("Keine Nutzer zum Senden.")
             return
         
-        sent = 0
-        for name, info in users.items():
-            if name != self.chat_client.username:
-                if self.chat_client.send_text_message(info['ip'], info['tcp_port'], name, message):
-                    sent += 1
-        print(f"Nachricht gesendet an {sent} / {len(users) - 1 if self.chat_client.username in users else len(users)}")
+        # Alle Empfänger parallel anschreiben, ein toter Peer bremst die anderen nicht aus
+        recipients = {name: info for name, info in users.items() if name != self.chat_client.username}
+        # Nicht erreichbare Peers werden im Hintergrund erneut versucht (OutboundQueue)
+        report = self.outbound_queue.send_to_many(recipients, message)
+
+        sent = sum(1 for status in report.values() if status == "ok")
+        print(f"Nachricht gesendet an {sent} / {len(recipients)}")
+
+        # Fehlgeschlagene Empfänger einzeln auflisten
+        for name, status in report.items():
+            if status != "ok":
+                print(f"  {name}: {status}")
 
     # Sendet eine private Nachricht an einen bestimmten Nutzer
     def send_private_message(self, username: str, message: str):
@@ -307,16 +320,18 @@ class CLI:
             print("Bitte zuerst mit /join <name> beitreten.")
             return
         
-        users = self.ipc_handler.get_active_users() # Ruft die Methode get_active_users() aus dem IPC Handler auf
-        user = users.get(username)
+        user = self.ipc_handler.get_user(username) # Direkter Zugriff über den Benutzernamen
         if not user:
             print(f"Nutzer {username} nicht bekannt.") # Wenn der Nutzer nicht bekannt ist, dem eine DM geschickt werden soll
             return
         
-        success = self.chat_client.send_text_message(user['ip'], user['tcp_port'], username, message)
-        if success:
+        status = self.outbound_queue.send(username, user, message)
+        if status == "ok":
             # Erfolgreiches Senden der Nachricht
             print(f"[Du → {username}]: {message}")
+        elif status in ("queued", "suspect"):
+            # Peer gerade nicht erreichbar, Nachricht wird im Hintergrund erneut gesendet
+            print(f"[Du → {username}]: {message} (wird zugestellt, sobald {username} erreichbar ist)")
         else:
             # Fehler beim Senden der Nachricht
             print(f"Senden fehlgeschlagen an {username}.")
@@ -335,14 +350,13 @@ class CLI:
             print(f"Bild nicht gefunden: {image_path}")
             return
         
-        users = self.ipc_handler.get_active_users() # Ruft die Methode get_active_users() aus dem IPC Handler auf
-        user = users.get(username) # Ruft den Nutzer aus der Liste der aktiven Nutzer ab
+        user = self.ipc_handler.get_user(username) # Ruft den Nutzer aus der Liste der aktiven Nutzer ab
 
         # Wenn der Nutzer nicht bekannt ist, wird eine entsprechende Nachricht ausgegeben
         if not user:
             print(f"Nutzer {username} nicht bekannt.")
             return
-        success = self.chat_client.send_image_message(user['ip'], user['tcp_port'], username, image_path)
+        success = self.chat_client.send_image_message(user.ip, user.tcp_port, username, image_path)
 
         if success:
             # Erfolgreiches Senden des Bildes
@@ -353,29 +367,26 @@ class CLI:
             print(f"Senden des Bildes an {username} fehlgeschlagen.")
 
     # Zeigt die Nachrichten an, die über den IPC-Handler empfangen werden
+    # Wacht auf, sobald eine Nachricht ankommt, und gibt alle wartenden auf einmal aus
     def display_messages(self):
         while self.running:
-            message = self.ipc_handler.get_message()
-            if message:
+            messages = self.ipc_handler.get_messages(max_n=100, timeout=1)
+            for message in messages:
                 self.show_message(message)
-            time.sleep(0.1) # Kurze Pause, um die CPU-Auslastung zu reduzieren
+            if messages:
+                print("> ", end="", flush=True) # Eingabeaufforderung einmal pro Schub neu anzeigen
 
     # Verarbeitet und zeigt eine einzelne Nachricht an
-    def show_message(self, message: Dict[str, Any]):
-        msg_type = message.get('type')
-        sender_ip = message.get('sender_ip', 'Unbekannt')
-        timestamp = message.get('timestamp', 0)
+    def show_message(self, message: ChatEvent):
+        msg_type = message.type
+        sender_ip = message.sender_ip or 'Unbekannt'
+        timestamp = message.timestamp
         time_str = time.strftime('%H:%M:%S', time.localtime(timestamp))
 
         # Überprüft, ob der Nachrichtentyp gültig ist
         # Wenn der msg Type text ist...
         if msg_type == 'text':
-            sender_name = None
-            users = self.ipc_handler.get_active_users(only_visible=False)
-            for name, info in users.items():
-                if info["ip"] == sender_ip:
-                    sender_name = name
-                    break
+            sender_name = self.ipc_handler.find_user_by_ip(sender_ip)
 
             local_ip = self.chat_client.config['network'].get('local_ip', '')  # Lokale IP-Adresse abfragen
 
@@ -384,20 +395,20 @@ class CLI:
 
             display_name = sender_name if sender_name else sender_ip # Wenn kein Name gefunden wurde, wird die IP-Adresse angezeigt
             
-            print(f"\n[{time_str}] Nachricht von {display_name}: {message.get('content')}") # Print Ausgabe der Nachricht
+            print(f"\n[{time_str}] Nachricht von {display_name}: {message.content}") # Print Ausgabe der Nachricht
 
-            if self.autoreply_active and sender_name:
+            sender_info = self.ipc_handler.get_user(sender_name) if sender_name else None
+            if self.autoreply_active and sender_info:
                 reply = self.config["system"].get("autoreply", "Ich bin gerade nicht verfügbar.")
-                self.chat_client.send_text_message(sender_ip, info["tcp_port"], sender_name, reply)
+                self.outbound_queue.send(sender_name, sender_info, reply)
 
         # Wenn der msg Type image ist...
         elif msg_type == 'image':
-            print(f"\n[{time_str}] Bild empfangen von {sender_ip}: {message.get('filename')}")
+            print(f"\n[{time_str}] Bild empfangen von {sender_ip}: {message.filename}")
 
         # Wenn der msg Type system ist...
         elif msg_type == 'system':
-            print(f"\n[{time_str}] SYSTEM: {message.get('content')}")
-        print("> ", end="", flush=True)
+            print(f"\n[{time_str}] SYSTEM: {message.content}")
 
 
     # Auskommentiertr Methode da sie nicht mehr benötigt wird
@@ -1,9 +1,18 @@
 import socket
+import struct
 import threading
 import time
+import random
+import hashlib
 from typing import Dict, Any
 import toml
 
+from ipc_handler import ChatEvent
+from gossip import GossipService
+
+
+# Maximale Länge einer KNOWUSERS-Zeile in Bytes (wie bei MSG), längere Listen werden aufgeteilt
+KNOWUSERS_FRAME_SIZE = 512
 
 class DiscoveryService:
     def __init__(self, config: Dict[str, Any], ipc_handler, username: str, chat_tcp_port: int):
@@ -11,7 +20,10 @@ class DiscoveryService:
         #Kommentare für Debugging Ausgabe
         print(f"[Discovery] Initialisiere DiscoveryService mit:")
         print(f"            • Chat-Port (TCP): {chat_tcp_port}")
-        print(f"            • Broadcast-Adresse: {config['network'].get('broadcast_address', '255.255.255.255')}")
+        if config['network'].get('discovery_mode', 'broadcast') == 'multicast':
+            print(f"            • Multicast-Gruppe: {config['network'].get('multicast_group', '239.255.42.99')}")
+        else:
+            print(f"            • Broadcast-Adresse: {config['network'].get('broadcast_address', '255.255.255.255')}")
         print(f"            • Discovery-Port (UDP): {config['network'].get('whoisport', 4000)}")
 
         # Initialisiert den Discovery-Service mit der Konfiguration, IPC-Handler, Benutzernamen und Chat-Port
@@ -25,6 +37,18 @@ class DiscoveryService:
         self.broadcast_ip = self.config["network"].get("broadcast_address", "255.255.255.255")
         self.discovery_port = self.config["network"].get("whoisport", 4000)
 
+        # Discovery per "broadcast" (Standard) oder "multicast": bei Multicast verarbeiten nur Hosts,
+        # die der Gruppe beigetreten sind, die JOIN/WHO/LEAVE-Pakete
+        self.discovery_mode = self.config["network"].get("discovery_mode", "broadcast")
+        self.multicast_group = self.config["network"].get("multicast_group", "239.255.42.99")
+        self.multicast_ttl = self.config["network"].get("multicast_ttl", 1)
+        self.multicast_loopback = self.config["network"].get("multicast_loopback", True)
+        self.multicast_interface = self.config["network"].get("multicast_interface", "") # leer = Standard-Interface
+        if self.discovery_mode == "multicast":
+            self.discovery_target = (self.multicast_group, self.discovery_port)
+        else:
+            self.discovery_target = (self.broadcast_ip, self.discovery_port)
+
         # Initialisiert den Discovery-Socket
         self.listen_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
@@ -35,6 +59,62 @@ class DiscoveryService:
             pass
         self.listen_socket.settimeout(1)
 
+        # Mitgliederverwaltung: "broadcast" (JOIN/WHO/KNOWUSERS) oder zusätzlich "gossip" (SWIM, siehe gossip.py)
+        self.membership_mode = self.config["network"].get("membership_mode", "broadcast")
+        self.gossip = GossipService(config, ipc_handler, self) if self.membership_mode == "gossip" else None
+
+        # Dauerhafter Sende-Socket für alle Broadcasts (JOIN, LEAVE, WHO), statt pro Nachricht einen neuen zu öffnen
+        self.send_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        if self.discovery_mode == "multicast":
+            self.send_socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, self.multicast_ttl)
+            self.send_socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1 if self.multicast_loopback else 0)
+            if self.multicast_interface:
+                self.send_socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(self.multicast_interface))
+        else:
+            self.send_socket.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        self.send_lock = threading.Lock()
+
+        # Gleiche Broadcasts innerhalb dieses Zeitfensters (Sekunden) werden nur einmal gesendet
+        self.broadcast_window = self.config["network"].get("broadcast_coalesce_window", 0.5)
+        self.last_broadcast = {} # Text -> Zeitpunkt (time.monotonic) des letzten Versands
+        self.last_prune = time.monotonic()
+
+        # Die Nutzerliste im IPCHandler dient als Cache: beim Senden wird sie direkt verwendet und
+        # höchstens alle membership_ttl Sekunden im Hintergrund per JOIN/WHO aufgefrischt
+        self.membership_ttl = self.config["network"].get("membership_ttl", 10)
+        self.last_refresh = 0.0 # Zeitpunkt (time.monotonic) der letzten Discovery-Anfrage
+        self.refreshing = False
+        self.refresh_lock = threading.Lock()
+
+        # Heartbeat: regelmäßiger JOIN per UDP (ohne TCP-Benachrichtigung der Peers), der unsere Lease
+        # (peer_timeout) bei allen Peers erneuert. Das Intervall passt sich der Anzahl der Peers und der
+        # beobachteten Discovery-Last an, bleibt aber unter peer_timeout / 3, damit die Lease nie abläuft.
+        self.heartbeat_min_interval = self.config["network"].get("heartbeat_min_interval", 5)
+        self.heartbeat_budget = self.config["network"].get("heartbeat_budget", 20) # Datagramme/s im ganzen Netz
+        self.heartbeat_interval = self.heartbeat_min_interval
+        self.received_datagrams = 0 # Zähler für die beobachtete Last
+        self.stop_event = threading.Event()
+
+        # KNOWUSERS-Antworten auf WHO werden nicht im Empfangs-Thread gesendet (TCP-Verbindungsaufbau
+        # kann Sekunden dauern), sondern von eigenen Reply-Workern. Pro Ziel-IP wartet höchstens eine Antwort.
+        self.reply_workers = self.config["network"].get("reply_workers", 4)
+        self.reply_queue_size = self.config["network"].get("reply_queue_size", 256)
+        self.reply_pending = {} # Ziel-IP -> Zeitpunkt (time.monotonic), ab dem geantwortet wird
+        self.reply_cond = threading.Condition()
+
+        # Unterdrückung von WHO-Stürmen: nur who_responders Peers antworten auf ein WHO, jeweils
+        # mit zufälliger Verzögerung bis reply_jitter Sekunden. Derselbe Anfrager bekommt innerhalb
+        # von reply_cache_ttl Sekunden nur dann erneut eine Antwort, wenn sich die Nutzerliste geändert hat.
+        self.who_responders = self.config["network"].get("who_responders", 3)
+        self.reply_jitter = self.config["network"].get("reply_jitter", 0.5)
+        self.reply_cache_ttl = self.config["network"].get("reply_cache_ttl", 5)
+        self.reply_cache = {} # Ziel-IP -> (Version der Nutzerliste, Zeitpunkt) der letzten Antwort
+
+        # Delta-Abgleich: (IP, TCP-Port) -> Version der Nutzerliste, die der Peer zuletzt bekommen hat
+        # (als WHO-Antwort oder beim Push). Wird bei einem JOIN mit neuem Handle oder Port vergessen.
+        self.sent_versions = {}
+        self.sent_lock = threading.Lock()
+
     # Start Methode
     def start(self):
         # Ausgabe fuer den Nutzer...
@@ -44,23 +124,56 @@ class DiscoveryService:
         # Versuche, den Discovery-Socket zu binden
         try:
             self.listen_socket.bind(('', self.discovery_port))
+            if self.discovery_mode == "multicast":
+                self.join_multicast_group()
             threading.Thread(target=self.listen_loop, daemon=True).start()
+            for _ in range(self.reply_workers):
+                threading.Thread(target=self.reply_loop, daemon=True).start()
+            # Heartbeats auch im Gossip-Modus: Peers ohne Gossip erneuern darüber unsere Lease
+            threading.Thread(target=self.heartbeat_loop, daemon=True).start()
         except OSError:
             # Falls das nicht klappt, gibt es einen Fehler
             print(f"[Discovery] Fehler: Port {self.discovery_port} bereits belegt oder nicht verfügbar.")
 
+        # Gossip nutzt einen eigenen UDP-Socket auf dem Chat-Port. Schlägt dessen Bind fehl,
+        # läuft die Mitgliederverwaltung wie im Broadcast-Modus weiter
+        if self.gossip:
+            try:
+                self.gossip.start()
+            except OSError as e:
+                print(f"[Discovery] Fehler: Gossip-Port {self.gossip.port}/UDP nicht verfügbar ({e}), "
+                      f"verwende membership_mode = \"broadcast\".")
+                self.gossip.stop()
+                self.gossip = None
+
         # Sende eine JOIN-Nachricht an alle Peers im Netzwerk
         self.send_join()
 
+    # Tritt mit dem Empfangs-Socket der Multicast-Gruppe bei (IP_ADD_MEMBERSHIP)
+    def join_multicast_group(self):
+        interface = self.multicast_interface or "0.0.0.0"
+        membership = struct.pack("4s4s", socket.inet_aton(self.multicast_group), socket.inet_aton(interface))
+        try:
+            self.listen_socket.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+            print(f"[Discovery] Multicast-Gruppe {self.multicast_group} beigetreten (Interface: {interface})")
+        except OSError as e:
+            print(f"[Discovery] Fehler beim Beitritt zur Multicast-Gruppe {self.multicast_group}: {e}")
+
     # Stop Methode
     def stop(self):
         # Ausgabe für den Nutzer...
         print("[Discovery] Beende Discovery-Service und schließe Socket...")
         self.running = False
+        self.stop_event.set()
         #self.send_leave()
+        with self.reply_cond:
+            self.reply_cond.notify_all() # Reply-Worker aufwecken, damit sie sich beenden
+        if self.gossip:
+            self.gossip.stop()
         
         try:
             self.listen_socket.close() # Schließt den Discovery-Socket
+            self.send_socket.close()
         except Exception:
             pass
 
@@ -68,7 +181,8 @@ class DiscoveryService:
     def listen_loop(self):
         while self.running:
             try:
-                data, addr = self.listen_socket.recvfrom(1024)
+                data, addr = self.listen_socket.recvfrom(65535)
+                self.received_datagrams += 1
                 message = data.decode('utf-8', errors='ignore').strip()
                 self.handle_message(message, addr[0])
             except socket.timeout:
@@ -93,19 +207,12 @@ class DiscoveryService:
 
                 # Wenn der Peer nicht der eigene Benutzername ist, aktualisiere die Benutzerliste
                 if peer != self.username:
-                    known_users = self.ipc_handler.get_active_users(only_visible=False)
-                    already_known = any(
-                        u == peer and info["ip"] == sender_ip and info["tcp_port"] == port
-                        for u, info in known_users.items()
-                    )
+                    already_known = self.ipc_handler.find_user_by_address(sender_ip, port) == peer
                     # Aktualisiere die Benutzerliste mit dem neuen Peer
                     self.ipc_handler.update_user_list(peer, sender_ip, port, time.time())
                     if not already_known:
-                        self.ipc_handler.send_message({
-                            'type': 'system',
-                            'content': f"JOIN {peer} {port}",
-                            'timestamp': time.time()
-                        })
+                        self.forget_sent_version(sender_ip) # (Neu-)Start des Peers: wieder vollständig abgleichen
+                        self.ipc_handler.send_message(ChatEvent('system', f"JOIN {peer} {port}"))
 
         # Leave Nachrichten verarbeiten
         elif message.startswith("LEAVE"):
@@ -114,39 +221,96 @@ class DiscoveryService:
                 peer = parts[1]
                 if peer != self.username:
                     self.ipc_handler.remove_user_by_name(peer)
-                    self.ipc_handler.send_message({
-                        'type': 'system',
-                        'content': f"LEAVE {peer}",
-                        'timestamp': time.time()
-                    })
+                    self.ipc_handler.send_message(ChatEvent('system', f"LEAVE {peer}"))
         # WHO-Nachrichten verarbeiten
         elif message == "WHO":
-            self.send_knowusers(sender_ip)
+            self.schedule_reply(sender_ip)
+
+        # Ein anderer Peer hat ein WHO beantwortet: "ANSWERED <Anfrager-IP> <Prüfsumme der Nutzerliste>"
+        elif message.startswith("ANSWERED"):
+            parts = message.split(" ")
+            if len(parts) == 3:
+                self.suppress_reply(parts[1], parts[2])
 
         # KNOWUSERS-Nachrichten verarbeiten
         elif message.startswith("KNOWUSERS"):
             payload = message[10:]
             
             # Teile die KNOWUSERS-Nachricht in ihre Bestandteile auf
+            updates = []
             for chunk in payload.split(","):
                 parts = chunk.strip().split(" ")
                 if len(parts) == 3:
                     peer, ip, port = parts[0], parts[1], int(parts[2])
                     if peer != self.username:
-                        self.ipc_handler.update_user_list(peer, ip, port, time.time()) # Aktualisiere die Benutzerliste
+                        updates.append((peer, ip, port))
+            self.ipc_handler.update_users(updates, time.time()) # Aktualisiere die Benutzerliste in einem Schritt
 
     # Sendet eine UDP-Broadcast-Nachricht an alle Peers im Netzwerk
-    def send_udp_broadcast(self, text: str):
-        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
-            s.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
-            s.sendto((text + "\n").encode('utf-8'), (self.broadcast_ip, self.discovery_port))
+    # Wurde derselbe Text innerhalb von broadcast_window schon gesendet, wird er nicht erneut verschickt.
+    # Mit coalesce=False wird immer gesendet und der Versand auch nicht für spätere Aufrufe vermerkt.
+    # Rückgabe: True, wenn die Nachricht tatsächlich gesendet wurde
+    def send_udp_broadcast(self, text: str, coalesce: bool = True) -> bool:
+        now = time.monotonic()
+        with self.send_lock:
+            if coalesce:
+                last = self.last_broadcast.get(text)
+                if last is not None and now - last < self.broadcast_window:
+                    return False
+                if now - self.last_prune >= self.broadcast_window:
+                    # Abgelaufene Einträge entfernen (höchstens einmal pro Zeitfenster), damit die Tabelle nicht wächst
+                    self.last_broadcast = {t: ts for t, ts in self.last_broadcast.items() if now - ts < self.broadcast_window}
+                    self.last_prune = now
+                self.last_broadcast[text] = now
+            try:
+                self.send_socket.sendto((text + "\n").encode('utf-8'), self.discovery_target)
+            except OSError as e:
+                print(f"[Discovery] Fehler beim Senden von '{text}': {e}")
+                return False
+        return True
 
     # Sendet eine JOIN-Nachricht an alle Peers im Netzwerk
     def send_join(self):
         if not self.username:
             return
-        self.send_udp_broadcast(f"JOIN {self.username} {self.chat_tcp_port}")
-        self.send_to_all_known_peers_as_knowuser()
+        if self.gossip:
+            self.gossip.announce() # eigenes ALIVE erst, wenn der Benutzername feststeht
+        # Wurde der JOIN gerade erst gesendet, ist auch die Benachrichtigung der bekannten Peers schon erfolgt.
+        # Im Gossip-Modus entfällt die TCP-Benachrichtigung aller Peers - das übernimmt das ALIVE im Gossip.
+        if self.send_udp_broadcast(f"JOIN {self.username} {self.chat_tcp_port}") and self.gossip is None:
+            self.send_to_all_known_peers_as_knowuser()
+
+    # Heartbeat: ein einfacher JOIN per UDP. Für die Empfänger ist das ein normales Lebenszeichen,
+    # es werden aber keine TCP-Verbindungen zu den bekannten Peers aufgebaut.
+    # Nicht zusammengefasst - sonst würde ein send_join kurz danach samt Benachrichtigung der Peers entfallen
+    def send_heartbeat(self):
+        if self.username:
+            self.send_udp_broadcast(f"JOIN {self.username} {self.chat_tcp_port}", coalesce=False)
+
+    # Berechnet das nächste Heartbeat-Intervall aus der Anzahl der Peers und der beobachteten Last
+    # (rate = empfangene Discovery-Datagramme pro Sekunde)
+    def next_heartbeat_interval(self, rate: float) -> float:
+        peers = len(self.ipc_handler.get_snapshot().users) + 1
+        interval = max(
+            self.heartbeat_min_interval,
+            peers / self.heartbeat_budget, # halten sich alle daran, senden alle zusammen heartbeat_budget/s
+            self.heartbeat_interval * rate / self.heartbeat_budget if rate > self.heartbeat_budget else 0
+        )
+        # Lease muss mindestens zwei verlorene Heartbeats überstehen
+        interval = min(interval, self.ipc_handler.peer_timeout / 3)
+        # Zufällige Abweichung von bis zu 10%, damit nicht alle Peers gleichzeitig senden
+        return interval * random.uniform(0.9, 1.1)
+
+    # Sendet Heartbeats, solange der Discovery-Service läuft
+    def heartbeat_loop(self):
+        last_count = self.received_datagrams
+        last_time = time.monotonic()
+        while not self.stop_event.wait(self.heartbeat_interval):
+            now = time.monotonic()
+            rate = (self.received_datagrams - last_count) / max(now - last_time, 0.001)
+            last_count, last_time = self.received_datagrams, now
+            self.send_heartbeat()
+            self.heartbeat_interval = self.next_heartbeat_interval(rate)
 
     # Sendet eine LEAVE-Nachricht an alle Peers im Netzwerk
     def send_leave(self):
@@ -154,36 +318,212 @@ class DiscoveryService:
 
     # Fordert eine Discovery-Nachricht an, um andere Peers zu finden
     def request_discovery(self):
+        with self.refresh_lock:
+            self.last_refresh = time.monotonic()
         self.send_join()
         time.sleep(0.05)
         self.send_udp_broadcast("WHO")
 
-    # Sendet eine KNOWUSERS-Nachricht an einen bestimmten Peer
-    def send_knowusers(self, target_ip: str):
-        users = self.ipc_handler.get_active_users(only_visible=True)
-        if not users:
-            return
-        parts = [f"{u} {info['ip']} {info['tcp_port']}" for u, info in users.items()]
-        msg = "KNOWUSERS " + ", ".join(parts) + "\n"
+    # Frischt die Nutzerliste im Hintergrund auf, falls die letzte Discovery länger als
+    # membership_ttl zurückliegt. Blockiert nie - der Aufrufer arbeitet mit der aktuellen Liste weiter.
+    # Rückgabe: True, wenn eine Auffrischung gestartet wurde
+    def refresh_membership(self) -> bool:
+        now = time.monotonic()
+        with self.refresh_lock:
+            if self.refreshing or now - self.last_refresh < self.membership_ttl:
+                return False
+            self.refreshing = True
+            self.last_refresh = now
+        threading.Thread(target=self.refresh_worker, daemon=True).start()
+        return True
 
+    # Hintergrund-Thread von refresh_membership
+    def refresh_worker(self):
+        try:
+            self.request_discovery()
+        finally:
+            with self.refresh_lock:
+                self.refreshing = False
+
+    # Reiht eine KNOWUSERS-Antwort an target_ip für die Reply-Worker ein und kehrt sofort zurück.
+    # Wartet für das Ziel schon eine Antwort, wird keine zweite eingereiht (sie enthält beim Senden
+    # ohnehin die dann aktuelle Nutzerliste). Ist die Warteschlange voll, wird die Anfrage verworfen.
+    # Rückgabe: True, wenn eine Antwort eingereiht ist
+    def schedule_reply(self, target_ip: str) -> bool:
+        if not self.is_responder(target_ip):
+            return False
+        now = time.monotonic()
+        with self.reply_cond:
+            if target_ip in self.reply_pending:
+                return True
+            cached = self.reply_cache.get(target_ip)
+            if cached and cached[0] == self.ipc_handler.get_version() and now - cached[1] < self.reply_cache_ttl:
+                return False # Anfrager hat diese Nutzerliste gerade erst bekommen
+            if len(self.reply_pending) >= self.reply_queue_size:
+                print(f"[Discovery] Zu viele offene WHO-Anfragen, Antwort an {target_ip} verworfen.")
+                return False
+            self.reply_pending[target_ip] = now + random.uniform(0, self.reply_jitter)
+            self.reply_cond.notify()
+        return True
+
+    # Entscheidet, ob wir auf ein WHO von requester_ip antworten. Alle Peers bilden dieselbe Rangfolge
+    # (Rendezvous-Hashing über Anfrager-IP und Handle) und nur die ersten who_responders antworten.
+    # Bei gleicher Nutzerliste antworten so unabhängig von der Anzahl der Peers nur wenige.
+    # Nur Peers mit gültiger Lease und Status "online" zählen - sonst könnten alle gewählten
+    # Antwortenden bereits weg (oder ungeprüft aus dem PeerCache) sein und niemand antwortet.
+    def is_responder(self, requester_ip: str) -> bool:
+        if self.who_responders <= 0:
+            return True # Unterdrückung abgeschaltet, jeder antwortet
+        snapshot = self.ipc_handler.get_snapshot()
+        now = time.time()
+        candidates = {name for name, info in snapshot.users.items()
+                      if info.visible and info.ip != requester_ip and info.status == 'online'
+                      and self.ipc_handler.is_alive(info, now)}
+        candidates.add(self.username)
+        if len(candidates) <= self.who_responders:
+            return True
+
+        def score(name: str) -> bytes:
+            return hashlib.blake2b(f"{requester_ip} {name}".encode("utf-8"), digest_size=8).digest()
+
+        own_score = score(self.username)
+        higher = sum(1 for name in candidates if score(name) > own_score)
+        return higher < self.who_responders
+
+    # Prüfsumme über die Mitglieder (Handle und TCP-Port aller weitergegebenen Peers plus uns selbst).
+    # Kennen zwei Peers dieselben Mitglieder, ist sie bei beiden gleich - ihre Antworten wären gleichwertig.
+    def membership_digest(self, snapshot) -> str:
+        entries = [f"{u} {info.tcp_port}" for u, info in snapshot.users.items()
+                   if info.visible and info.status != 'unverified']
+        entries.append(f"{self.username} {self.chat_tcp_port}")
+        return hashlib.blake2b("\n".join(sorted(entries)).encode("utf-8"), digest_size=8).hexdigest()
+
+    # Ein anderer Peer hat target_ip mit einer Liste der Prüfsumme digest beantwortet (ANSWERED).
+    # Stimmt sie mit unserer überein, wird nur unsere wartende Antwort an diesen Anfrager verworfen.
+    def suppress_reply(self, target_ip: str, digest: str):
+        with self.reply_cond:
+            if target_ip not in self.reply_pending:
+                return
+        snapshot = self.ipc_handler.get_snapshot()
+        if digest != self.membership_digest(snapshot):
+            return # andere Sicht auf die Mitglieder - unsere Antwort enthält womöglich mehr
+        with self.reply_cond:
+            if self.reply_pending.pop(target_ip, None) is not None:
+                self.reply_cache[target_ip] = (snapshot.version, time.monotonic()) # gilt als beantwortet
+
+    # Reply-Worker: sendet die eingereihten KNOWUSERS-Antworten, sobald ihre Verzögerung abgelaufen ist
+    def reply_loop(self):
+        while True:
+            with self.reply_cond:
+                while True:
+                    if not self.running:
+                        return
+                    delay = None
+                    if self.reply_pending:
+                        target_ip, due = min(self.reply_pending.items(), key=lambda item: item[1])
+                        delay = due - time.monotonic()
+                        if delay <= 0:
+                            break
+                    self.reply_cond.wait(delay)
+                del self.reply_pending[target_ip]
+                self.remember_reply(target_ip)
+            self.send_knowusers(target_ip)
+
+    # Merkt sich, welche Version der Nutzerliste target_ip bekommen hat (nur mit self.reply_cond aufrufen)
+    def remember_reply(self, target_ip: str):
+        now = time.monotonic()
+        if len(self.reply_cache) >= self.reply_queue_size:
+            self.reply_cache = {ip: entry for ip, entry in self.reply_cache.items() if now - entry[1] < self.reply_cache_ttl}
+        self.reply_cache[target_ip] = (self.ipc_handler.get_version(), now)
+
+    # Beantwortet ein WHO mit KNOWUSERS. Hat der Peer schon eine Liste von uns bekommen, gehen nur die
+    # Änderungen seitdem raus (delta_frames) - hat sich nichts geändert, wird keine Verbindung aufgebaut.
+    # Sonst die vollständige Liste, aufgeteilt in Zeilen von höchstens KNOWUSERS_FRAME_SIZE Bytes.
+    # Ein JOIN mit neuem Handle oder Port setzt den Abgleich zurück (forget_sent_version). Einen schnellen
+    # Neustart mit gleichem Port sieht man nicht - fehlende Einträge kommen dann mit den Heartbeats.
+    def send_knowusers(self, target_ip: str):
         target_port = self.chat_tcp_port
 
-        for info in self.ipc_handler.get_active_users(only_visible=False).values():
-            if info['ip'] == target_ip:
-                target_port = info['tcp_port']
-                break
+        # Beide Nachschläge auf demselben Snapshot, damit der Peer nicht zwischendurch verschwindet
+        snapshot = self.ipc_handler.get_snapshot()
+        for target_name in snapshot.ip_index.get(target_ip, ()):
+            target_port = snapshot.users[target_name].tcp_port
+            break
+        target = (target_ip, target_port)
+
+        version, frames = self.delta_frames(target)
+        if version is None:
+            # Ungeprüfte Einträge aus dem PeerCache werden nicht weitergegeben
+            entries = [f"{u} {info.ip} {info.tcp_port}" for u, info in snapshot.users.items()
+                       if info.visible and info.status != 'unverified']
+            if not entries:
+                return
+            version, frames = snapshot.version, self.knowusers_frames(entries)
+        else:
+            snapshot = self.ipc_handler.get_snapshot()
 
         try:
-            with socket.create_connection(
-                (target_ip, target_port),
-                timeout=self.config['system']['socket_timeout']
-            ) as sock:
-                sock.sendall(msg.encode('utf-8'))
+            if frames:
+                with socket.create_connection(
+                    target,
+                    timeout=self.config['system']['socket_timeout']
+                ) as sock:
+                    sock.sendall("".join(frames).encode('utf-8'))
+                with self.sent_lock:
+                    self.sent_versions[target] = version
+            # Den anderen Antwortenden mitteilen, dass dieser Anfrager auf unserem Stand ist (siehe suppress_reply)
+            self.send_udp_broadcast(f"ANSWERED {target_ip} {self.membership_digest(snapshot)}")
 
         # Error-Handling
         except Exception as e:
             print(f"[Discovery] Fehler beim Senden von KNOWUSERS an {target_ip}:{target_port}: {e}")
 
+    # Änderungen seit der Version, die target zuletzt bekommen hat: neue bzw. geänderte Einträge als
+    # KNOWUSERS, per LEAVE abgemeldete als LEAVE. Lokal abgelaufene oder als ausgefallen erkannte Peers
+    # werden nicht gemeldet, beim Empfänger läuft deren Lease selbst ab.
+    # Rückgabe: (neue Version, Zeilen) - (None, []) wenn target noch keine Liste von uns hat
+    # oder das Änderungsprotokoll nicht mehr so weit zurückreicht
+    def delta_frames(self, target: tuple):
+        with self.sent_lock:
+            last_version = self.sent_versions.get(target)
+        if last_version is None:
+            return None, []
+        # Änderungen zuerst, dann der Snapshot: der ist mindestens so neu wie die Änderungen
+        version, changed = self.ipc_handler.changes_since(last_version)
+        if changed is None:
+            return None, []
+        users = self.ipc_handler.get_snapshot().users
+        entries = [f"{u} {users[u].ip} {users[u].tcp_port}" for u in changed
+                   if u in users and users[u].visible and users[u].status != 'unverified']
+        left = self.ipc_handler.departed_among(changed)
+        return version, self.knowusers_frames(entries) + [f"LEAVE {u}\n" for u in sorted(left)]
+
+    # Teilt KNOWUSERS-Einträge ("handle ip port") auf Zeilen von höchstens KNOWUSERS_FRAME_SIZE Bytes auf
+    @staticmethod
+    def knowusers_frames(entries) -> list:
+        frames = []
+        current = []
+        size = len("KNOWUSERS \n")
+        for entry in entries:
+            length = len(entry.encode('utf-8')) + (2 if current else 0) # ", " als Trenner
+            if current and size + length > KNOWUSERS_FRAME_SIZE:
+                frames.append("KNOWUSERS " + ", ".join(current) + "\n")
+                current = []
+                size = len("KNOWUSERS \n")
+                length -= 2
+            current.append(entry)
+            size += length
+        if current:
+            frames.append("KNOWUSERS " + ", ".join(current) + "\n")
+        return frames
+
+    # Vergisst die zuletzt an einen Peer gesendete Version (z.B. nach seinem JOIN),
+    # die nächste KNOWUSERS-Antwort an ihn enthält dann wieder die vollständige Liste
+    def forget_sent_version(self, ip: str):
+        with self.sent_lock:
+            for target in [target for target in self.sent_versions if target[0] == ip]:
+                del self.sent_versions[target]
+
     # Sendet die KNOWUSERS-Nachricht an alle bekannten Peers, nachdem der Peer dem Chat beigetreten ist
     def send_to_all_known_peers_as_knowuser(self):
 
@@ -193,19 +533,26 @@ class DiscoveryService:
             return
 
         # Erstelle die KNOWUSERS-Nachricht mit der eigenen IP und dem Chat-Port
-        # und sende sie an alle anderen Peers
+        # und sende sie an alle anderen Peers. Wer schon eine Liste von uns hat, bekommt
+        # zusätzlich die Änderungen seitdem (delta_frames).
         self_entry = f"{self.username} {self.config['network'].get('local_ip')} {self.chat_tcp_port}"
         msg = "KNOWUSERS " + self_entry + "\n"
 
         for name, info in users.items():
-            if name == self.username:
+            # Ungeprüfte Einträge aus dem PeerCache prüft der PeerCache selbst (mit kurzem Timeout)
+            if name == self.username or info.status == 'unverified':
                 continue
+            target = (info.ip, info.tcp_port)
+            version, frames = self.delta_frames(target)
             try:
                 with socket.create_connection(
-                    (info['ip'], info['tcp_port']),
+                    target,
                     timeout=self.config['system']['socket_timeout']
                 ) as sock:
-                    sock.sendall(msg.encode("utf-8"))
+                    sock.sendall((msg + "".join(frames)).encode("utf-8"))
+                if version is not None:
+                    with self.sent_lock:
+                        self.sent_versions[target] = version
 
             # Error-Handling
             except Exception as e:
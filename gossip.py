@@ -0,0 +1,356 @@
+import math
+import random
+import socket
+import threading
+import time
+from typing import Dict, Any
+
+from ipc_handler import ChatEvent
+
+
+class GossipService:
+    # Optionale Mitgliederverwaltung nach dem SWIM-Prinzip (membership_mode = "gossip").
+    # Statt dass jeder Peer jeden anderen per Broadcast bzw. TCP benachrichtigt, prüft jeder Peer
+    # pro Runde (gossip_interval) genau einen zufälligen anderen Peer per UDP-PING. Bleibt das ACK aus,
+    # bitten gossip_indirect andere Peers per PINGREQ um einen indirekten Test. Erst danach gilt der Peer
+    # als "suspect" und nach gossip_suspect_timeout als ausgefallen - es sei denn, er widerlegt den
+    # Verdacht mit einer höheren Inkarnationsnummer. Änderungen (ALIVE, SUSPECT, DEAD) werden an die
+    # PING/ACK-Pakete angehängt. Die Last pro Peer bleibt damit unabhängig von der Anzahl der Peers.
+    # Getestet werden nur Peers, die selbst Gossip sprechen (PING/ACK/PINGREQ oder ALIVE gesehen).
+    # Andere bekannte Peers bekommen einmalig ein PING ohne Verdacht bei fehlendem ACK - antworten sie,
+    # sprechen sie Gossip. Peers im Broadcast-Modus halten ihre Lease über die Heartbeats der Discovery.
+    #
+    # Pakete (UDP, gleiche Portnummer wie der Chat-Server per TCP), erste Zeile ist der Befehl:
+    #   PING <seq> <handle> <port>
+    #   ACK <seq> <handle> <port>
+    #   PINGREQ <seq> <ziel-ip> <ziel-port> <handle> <port>
+    # danach beliebig viele Zeilen mit Änderungen:
+    #   ALIVE <handle> <ip> <port> <inkarnation>
+    #   SUSPECT <handle> <ip> <port> <inkarnation>
+    #   DEAD <handle> <inkarnation>
+    def __init__(self, config: Dict[str, Any], ipc_handler, discovery):
+        network = config.get('network', {})
+        self.config = config
+        self.ipc_handler = ipc_handler
+        self.discovery = discovery # liefert den aktuellen Benutzernamen und den Chat-Port
+        self.port = discovery.chat_tcp_port
+
+        self.interval = network.get('gossip_interval', 1.0) # Sekunden pro Prüfrunde
+        self.ack_timeout = network.get('gossip_ack_timeout', 0.3) # Wartezeit auf das direkte ACK
+        self.indirect = network.get('gossip_indirect', 3) # Anzahl Peers für den indirekten Test
+        self.suspect_timeout = network.get('gossip_suspect_timeout', 5) # Sekunden von "suspect" bis ausgefallen
+        self.piggyback = network.get('gossip_piggyback', 6) # maximale Anzahl angehängter Änderungen pro Paket
+
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.settimeout(1)
+
+        self.lock = threading.Lock()
+        self.running = False
+        self.stop_event = threading.Event()
+
+        # Startwert aus der Uhrzeit: nach einem Neustart ist die Inkarnation höher als alles, was andere noch kennen
+        self.incarnation = int(time.time())
+        self.incarnations = {} # handle -> höchste bekannte Inkarnation
+        self.members = set() # Peers, die nachweislich Gossip sprechen - nur diese werden getestet
+        self.invited = set() # Peers ohne Gossip-Nachweis, die schon ein einmaliges PING bekommen haben
+        self.suspects = {} # handle -> Zeitpunkt (time.monotonic), ab dem der Peer als ausgefallen gilt
+        self.updates = {} # handle -> [Zeile, verbleibende Weitergaben]
+        self.seq = 0
+        self.acks = {} # seq -> threading.Event für eigene Tests
+        self.forwards = {} # seq -> (Adresse des Anfragers, dessen seq, Zeitpunkt) für PINGREQ
+        self.probe_order = [] # Reihenfolge der Peers in der aktuellen Runde (zufällig gemischt)
+        self.last_touch = 0.0
+        self.announced = None # Handle, für den zuletzt ein eigenes ALIVE eingereiht wurde
+
+    def start(self):
+        self.socket.bind(('', self.port))
+        self.running = True
+        threading.Thread(target=self.listen_loop, daemon=True).start()
+        threading.Thread(target=self.probe_loop, daemon=True).start()
+
+    # Reiht die eigene Ankündigung (ALIVE) ein, sobald ein Benutzername gesetzt ist bzw. wenn er sich
+    # geändert hat. Wird von DiscoveryService.send_join aufgerufen - beim Start ist der Name oft noch leer.
+    def announce(self):
+        handle = self.discovery.username
+        if not handle or handle == self.announced:
+            return
+        self.announced = handle
+        self.queue_update(handle, self.alive_line())
+
+    def stop(self):
+        self.running = False
+        self.stop_event.set()
+        try:
+            self.socket.close()
+        except OSError:
+            pass
+
+    # Empfängt PING, ACK und PINGREQ samt angehängten Änderungen
+    def listen_loop(self):
+        while self.running:
+            try:
+                data, addr = self.socket.recvfrom(65535)
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            try:
+                self.handle_datagram(data.decode('utf-8', errors='ignore'), addr)
+            except (ValueError, IndexError) as e:
+                print(f"[Gossip] Ungültiges Paket von {addr[0]}: {e}")
+
+    def handle_datagram(self, text: str, addr):
+        lines = text.splitlines()
+        if not lines:
+            return
+        for line in lines[1:]:
+            self.apply_update(line)
+
+        parts = lines[0].split(" ")
+        cmd = parts[0]
+        if cmd in ("PING", "ACK") and len(parts) == 4 and parts[2]:
+            seq, handle, port = int(parts[1]), parts[2], int(parts[3])
+            self.mark_alive(handle, addr[0], port)
+            if cmd == "PING":
+                self.send(addr, f"ACK {seq} {self.discovery.username} {self.port}")
+            else:
+                self.ack_received(seq)
+
+        elif cmd == "PINGREQ" and len(parts) == 6 and parts[4]:
+            seq, target_ip, target_port = int(parts[1]), parts[2], int(parts[3])
+            self.mark_alive(parts[4], addr[0], int(parts[5]))
+            # Ziel stellvertretend anpingen, das ACK geht in ack_received an den Anfrager weiter
+            own_seq = self.next_seq()
+            with self.lock:
+                self.forwards[own_seq] = (addr, seq, time.monotonic())
+            self.send((target_ip, target_port), f"PING {own_seq} {self.discovery.username} {self.port}")
+
+    # Direkter Kontakt mit einem Peer: last_seen auffrischen und einen Verdacht aufheben
+    def mark_alive(self, handle: str, ip: str, port: int):
+        if handle == self.discovery.username:
+            return
+        self.ipc_handler.update_user_list(handle, ip, port, time.time())
+        with self.lock:
+            self.members.add(handle)
+            was_suspect = self.suspects.pop(handle, None) is not None
+        if was_suspect:
+            self.ipc_handler.set_user_status(handle, 'online')
+
+    def ack_received(self, seq: int):
+        with self.lock:
+            event = self.acks.get(seq)
+            forward = self.forwards.pop(seq, None)
+        if event is not None:
+            event.set()
+        if forward is not None:
+            addr, requester_seq, _ = forward
+            self.send(addr, f"ACK {requester_seq} {self.discovery.username} {self.port}")
+
+    # Wendet eine angehängte Änderung an und gibt sie weiter, wenn sie neu war
+    def apply_update(self, line: str):
+        parts = line.split(" ")
+        kind = parts[0]
+        if kind in ("ALIVE", "SUSPECT") and len(parts) == 5:
+            handle, ip, port, incarnation = parts[1], parts[2], int(parts[3]), int(parts[4])
+        elif kind == "DEAD" and len(parts) == 3:
+            handle, incarnation = parts[1], int(parts[2])
+        else:
+            return
+        if not handle:
+            return # Absender ohne Benutzernamen (z.B. vor /join) - nicht übernehmen
+
+        # Verdacht gegen uns selbst: mit einer höheren Inkarnation als der des Verdachts widerlegen
+        if handle == self.discovery.username:
+            if kind != "ALIVE":
+                if incarnation >= self.incarnation:
+                    self.incarnation = incarnation + 1
+                self.queue_update(handle, self.alive_line())
+            return
+
+        known = self.ipc_handler.get_user(handle)
+        with self.lock:
+            known_incarnation = self.incarnations.get(handle)
+            if known_incarnation is not None and incarnation < known_incarnation:
+                return # veraltete Information
+            if kind == "ALIVE" and known_incarnation is not None and incarnation == known_incarnation:
+                return # nichts Neues
+            if kind == "SUSPECT" and (known is None or (handle in self.suspects and incarnation == known_incarnation)):
+                return # unbekannt oder schon verdächtigt
+            if kind == "DEAD" and known is None:
+                return
+            self.incarnations[handle] = incarnation
+
+        if kind == "ALIVE":
+            self.ipc_handler.update_user_list(handle, ip, port, time.time())
+            with self.lock:
+                self.members.add(handle) # ALIVE stammt immer aus der Ankündigung des Peers selbst
+                was_suspect = self.suspects.pop(handle, None) is not None
+            if was_suspect:
+                self.ipc_handler.set_user_status(handle, 'online')
+            if known is None:
+                self.ipc_handler.send_message(ChatEvent('system', f"JOIN {handle} {port}"))
+            elif not was_suspect and known_incarnation is None:
+                return # Peer war schon bekannt, nur seine Inkarnation nicht - nichts weiterzugeben
+        elif kind == "SUSPECT":
+            with self.lock:
+                self.suspects[handle] = time.monotonic() + self.suspect_timeout
+            self.ipc_handler.set_user_status(handle, 'suspect')
+        else:
+            self.declare_dead(handle)
+            return # declare_dead verbreitet die Änderung selbst
+        self.queue_update(handle, line)
+
+    # Prüfrunden: pro Runde ein Peer, danach abgelaufene Verdachtsfälle und last_seen erledigen
+    def probe_loop(self):
+        while self.running:
+            started = time.monotonic()
+            try:
+                self.probe_next()
+                self.expire_suspects()
+                self.touch_members()
+            except Exception as e:
+                print(f"[Gossip] Fehler in der Prüfrunde: {e}")
+            remaining = self.interval - (time.monotonic() - started)
+            if remaining > 0:
+                self.stop_event.wait(remaining)
+
+    # Testet den nächsten Peer direkt und bei Bedarf indirekt über andere Peers
+    # Ohne eigenen Benutzernamen wird nicht getestet - die Empfänger verwerfen PINGs ohne Handle
+    def probe_next(self):
+        if not self.discovery.username:
+            return
+        handle = self.next_target()
+        if handle is None:
+            return
+        info = self.ipc_handler.get_user(handle)
+        with self.lock:
+            is_member = handle in self.members
+            if not is_member:
+                self.invited.add(handle)
+        if not is_member:
+            # Nur anfragen, ob der Peer Gossip spricht - ein fehlendes ACK ist hier kein Ausfall
+            self.send((info.ip, info.tcp_port), f"PING {self.next_seq()} {self.discovery.username} {self.port}")
+            return
+        seq = self.next_seq()
+        event = threading.Event()
+        with self.lock:
+            self.acks[seq] = event
+        try:
+            self.send((info.ip, info.tcp_port), f"PING {seq} {self.discovery.username} {self.port}")
+            if event.wait(self.ack_timeout):
+                return
+
+            # Kein direktes ACK: andere Peers bitten, das Ziel zu testen
+            users = self.ipc_handler.get_snapshot().users
+            with self.lock:
+                others = [name for name in users if name in self.members and name != handle]
+            for helper in random.sample(others, min(self.indirect, len(others))):
+                helper_info = users[helper]
+                self.send((helper_info.ip, helper_info.tcp_port),
+                          f"PINGREQ {seq} {info.ip} {info.tcp_port} {self.discovery.username} {self.port}")
+
+            if event.wait(max(0, self.interval - self.ack_timeout)):
+                self.mark_alive(handle, info.ip, info.tcp_port)
+                return
+            self.suspect(handle)
+        finally:
+            with self.lock:
+                self.acks.pop(seq, None)
+
+    # Nächster Peer der aktuellen Runde. Jede Runde wird neu gemischt, so wird jeder Gossip-Peer
+    # innerhalb von N Prüfrunden mindestens einmal getestet. Dazu kommen noch nicht angefragte Peers.
+    def next_target(self):
+        users = self.ipc_handler.get_snapshot().users
+        if not self.probe_order:
+            with self.lock:
+                # Entfernte Peers vergessen, sie melden sich mit PING oder ALIVE zurück
+                self.members &= users.keys()
+                self.invited &= users.keys()
+                self.probe_order = [name for name in users if name != self.discovery.username
+                                    and (name in self.members or name not in self.invited)]
+            random.shuffle(self.probe_order)
+        while self.probe_order:
+            handle = self.probe_order.pop()
+            if handle in users:
+                return handle
+        return None
+
+    def suspect(self, handle: str):
+        info = self.ipc_handler.get_user(handle)
+        if info is None:
+            return
+        with self.lock:
+            if handle in self.suspects:
+                return
+            self.suspects[handle] = time.monotonic() + self.suspect_timeout
+            incarnation = self.incarnations.setdefault(handle, 0)
+        self.ipc_handler.set_user_status(handle, 'suspect')
+        self.queue_update(handle, f"SUSPECT {handle} {info.ip} {info.tcp_port} {incarnation}")
+
+    # Entfernt Peers, deren Verdacht nicht rechtzeitig widerlegt wurde
+    def expire_suspects(self):
+        now = time.monotonic()
+        with self.lock:
+            expired = [handle for handle, deadline in self.suspects.items() if deadline <= now]
+            # Verwaiste PINGREQ-Weiterleitungen aufräumen
+            for seq in [seq for seq, entry in self.forwards.items() if now - entry[2] > 2 * self.interval]:
+                del self.forwards[seq]
+        for handle in expired:
+            self.declare_dead(handle)
+
+    def declare_dead(self, handle: str):
+        with self.lock:
+            self.suspects.pop(handle, None)
+            self.members.discard(handle)
+            incarnation = self.incarnations.setdefault(handle, 0)
+        if self.ipc_handler.get_user(handle) is None:
+            return
+        self.ipc_handler.remove_user(handle)
+        self.ipc_handler.send_message(ChatEvent('system', f"{handle} ist nicht mehr erreichbar."))
+        self.queue_update(handle, f"DEAD {handle} {incarnation}")
+
+    # Die Fehlererkennung übernimmt das Protokoll: alle nicht verdächtigen Gossip-Peers gelten als gesehen,
+    # damit der peer_timeout des IPCHandlers sie nicht entfernt, nur weil sie selten getestet werden.
+    # Peers ohne Gossip werden nicht angefasst, für sie gilt weiter die Lease aus den Heartbeats.
+    def touch_members(self):
+        now = time.monotonic()
+        if now - self.last_touch < self.ipc_handler.peer_timeout / 3:
+            return
+        self.last_touch = now
+        users = self.ipc_handler.get_snapshot().users
+        with self.lock:
+            alive = [name for name in users if name in self.members and name not in self.suspects]
+        self.ipc_handler.touch_users(alive)
+
+    # Merkt sich eine Änderung zum Anhängen. Jede wird etwa 3*log2(N) mal weitergegeben,
+    # das reicht, damit sie mit hoher Wahrscheinlichkeit alle Peers erreicht.
+    def queue_update(self, handle: str, line: str):
+        count = len(self.ipc_handler.get_snapshot().users) + 1
+        with self.lock:
+            self.updates[handle] = [line, 3 * math.ceil(math.log2(count + 1))]
+
+    # Sendet ein Paket mit angehängten Änderungen (die am seltensten weitergegebenen zuerst)
+    def send(self, addr, header: str):
+        with self.lock:
+            chosen = sorted(self.updates.items(), key=lambda item: -item[1][1])[:self.piggyback]
+            lines = [header]
+            for handle, entry in chosen:
+                lines.append(entry[0])
+                entry[1] -= 1
+                if entry[1] <= 0:
+                    del self.updates[handle]
+        try:
+            self.socket.sendto("\n".join(lines).encode('utf-8'), addr)
+        except OSError as e:
+            if self.running:
+                print(f"[Gossip] Senden an {addr[0]}:{addr[1]} fehlgeschlagen: {e}")
+
+    def alive_line(self) -> str:
+        local_ip = self.config['network'].get('local_ip', '127.0.0.1')
+        return f"ALIVE {self.discovery.username} {local_ip} {self.port} {self.incarnation}"
+
+    def next_seq(self) -> int:
+        with self.lock:
+            self.seq += 1
+            return self.seq
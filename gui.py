@@ -5,12 +5,25 @@ import time
 import os
 import toml
 import socket
+import queue
+from concurrent.futures import ThreadPoolExecutor
 
 # Importiere die benötigten Module
 from ipc_handler import IPCHandler
 from discovery import DiscoveryService
 from chat_client import ChatClient
-from chat_server import ChatServer
+from outbound_queue import OutboundQueue
+from peer_cache import PeerCache
+from chat_server import create_chat_server
+from scrollback import ScrollbackLog, split_lines
+
+
+# Intervall der Nachrichten-Abfrage in ms: bei Verkehr schnell, im Leerlauf langsam
+POLL_INTERVAL_MIN = 20
+POLL_INTERVAL_MAX = 200
+
+# Anzahl Hintergrund-Threads für Netzwerkzugriffe (Senden, Discovery) aus der GUI
+GUI_WORKERS = 4
 
 
 class ChatGUI:
@@ -38,6 +51,9 @@ class ChatGUI:
         self.users_listbox = tk.Listbox(main_frame, width=20, height=20)
         self.users_listbox.grid(row=0, column=0, sticky=(tk.W, tk.E, tk.N, tk.S), padx=(0, 10))
         self.users_listbox.bind("<Double-Button-1>", self.on_user_double_click)
+        self.user_rows = [] # Aktuell angezeigte Zeilen als (Sortierschlüssel, Text)
+        self.rendered_version = None # Version der Nutzerliste, die gerade angezeigt wird
+        self.rendered_own_row = None
 
 
         # Message input
@@ -79,6 +95,15 @@ class ChatGUI:
         cfg_path = os.path.join(os.path.dirname(__file__), "config.toml")
         config   = toml.load(cfg_path)
 
+        # Begrenzter Verlauf im Chat-Fenster, ältere Zeilen liegen im ScrollbackLog auf der Festplatte
+        self.scrollback = ScrollbackLog()
+        self.scrollback_lines = config['system'].get('scrollback_lines', 1000) # maximal angezeigte Zeilen
+        self.scrollback_trim = config['system'].get('scrollback_trim', 200) # Zeilen pro Kürzung bzw. nachgeladener Seite
+        self.view_start = 0 # Erste angezeigte Zeile (Index im Verlauf)
+        self.view_end = 0 # Hinter der letzten angezeigten Zeile
+        self.page_pending = False
+        self.chat_display.configure(yscrollcommand=self.on_chat_scroll)
+
         #
         s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         try:
@@ -106,28 +131,34 @@ class ChatGUI:
 
         # IPC-Handler und Discovery-Service initialisieren
         chat_tcp_port     = config["network"].get("chat_port", 5001)
-        self.ipc_handler  = IPCHandler()
+        self.ipc_handler  = IPCHandler(config["network"].get("peer_timeout", 60))
+        self.ipc_handler.start_expiry()  # Inaktive Nutzer bei Ablauf ihres Timeouts entfernen
         self.discovery    = DiscoveryService(config, self.ipc_handler, self.username, chat_tcp_port)
 
         # Autoreply standard deaktiviert
         self.autoreply_active = False
+
+        # Netzwerkzugriffe laufen nie im Tk-Thread: sie werden an self.worker übergeben,
+        # die Ergebnisse kommen über self.ui_queue zurück und werden in poll_messages angezeigt
+        self.worker = ThreadPoolExecutor(max_workers=GUI_WORKERS, thread_name_prefix="gui")
+        self.ui_queue = queue.SimpleQueue()
         
         # Chat-Client initialisieren
         self.chat_client = ChatClient(config, self.username)
+        self.outbound_queue = OutboundQueue(config, self.chat_client, self.ipc_handler)
+        self.peer_cache = PeerCache(config, self.ipc_handler, self.chat_client)
+        self.peer_cache.start() # Zuletzt bekannte Peers laden und im Hintergrund prüfen
 
         # Chat-Server initialisieren
-        self.chat_server = ChatServer(config, self.ipc_handler)
+        self.chat_server = create_chat_server(config, self.ipc_handler)
         self.chat_server.start()
 
-        self.discovery.start()  # Discovery-Service starten
+        # Discovery starten (JOIN samt TCP-Benachrichtigung der bekannten Peers), JOIN wiederholen
+        # und WHO senden - im Hintergrund, ohne das Anzeigen des Fensters zu verzögern
+        self.run_in_background(self.start_discovery)
         self.is_connected = True  # Status der Verbindung
-        self.discovery.send_join()
         self.display_system_message(f"JOIN als '{self.username}' versendet")
 
-        time.sleep(0.5)  # Kurze Pause, um sicherzustellen, dass Discovery gestartet ist
-        self.discovery.request_discovery()  # Discovery anfordern
-
-
         
         # Starte die Nutzer-Aktualisierung
         self.start_user_update_loop()
@@ -144,40 +175,74 @@ class ChatGUI:
 
 
     # Aktualisiert die Liste der aktiven Nutzer
+    # Die Liste wird nicht neu aufgebaut: nur geänderte, neue oder entfernte Zeilen
+    # werden angefasst (Auswahl und Scrollposition bleiben erhalten). Hat sich weder
+    # die Version der Nutzerliste noch die eigene Zeile geändert, passiert gar nichts.
     def update_active_users(self):
         """Aktualisiert die Liste der aktiven Nutzer"""
-        # Liste leeren
-        self.users_listbox.delete(0, tk.END)
+        snapshot = self.ipc_handler.get_snapshot() # Aktueller Stand ohne Lock und ohne Kopie
 
         # ← FIX: Prüfen ob is_connected existiert
         is_connected = getattr(self, 'is_connected', False)
 
         # Eigenen Username anzeigen (wenn verbunden)
+        own_row = None
         if is_connected:
             local_ip = self.chat_client.config['network'].get('local_ip', 'localhost')
             chat_port = self.chat_client.config['network'].get('chat_port', 5001)
-            self.users_listbox.insert(tk.END, f"{self.username} (Du) @ {local_ip}:{chat_port}")
-
-        # ← FIX: Nur aktive und erreichbare Nutzer anzeigen
-        users = self.ipc_handler.get_active_users()
-        active_users = []
-        
-        for name, info in users.items():
-            if name != self.username:
-                status = info.get('status', 'online')
-                last_seen = info.get('last_seen', 0)
-                current_time = time.time()
-                
-                # Nur Nutzer anzeigen die in den letzten 90 Sekunden aktiv waren
-                if current_time - last_seen < 90 and status == 'online':
-                    active_users.append((name, info))
+            own_row = f"{self.username} (Du) @ {local_ip}:{chat_port}"
+
+        if snapshot.version == self.rendered_version and own_row == self.rendered_own_row:
+            return # Nichts geändert
+
+        # Gewünschte Zeilen als (Sortierschlüssel, Text): eigene Zeile, dann die anderen Nutzer alphabetisch
+        rows = []
+        if own_row:
+            rows.append(((0, ''), own_row))
+
+        # Nur noch aktive Nutzer stehen in der Liste - abgelaufene entfernt der IPC-Handler
+        # (gleiche Lease-Prüfung wie in der CLI über IPCHandler.is_alive)
+        now = time.time()
+        for name in sorted(snapshot.users):
+            info = snapshot.users[name]
+            if name != self.username and info.visible and self.ipc_handler.is_alive(info, now):
+                user_display = f"{name} @ {info.ip}:{info.tcp_port}"
+                if info.status == 'suspect':
+                    user_display += " (reagiert nicht)"
+                elif info.status == 'unverified':
+                    user_display += " (wird geprüft)"
+                rows.append(((1, name), user_display))
         
-        if not active_users:
-            self.users_listbox.insert(tk.END, "Keine anderen Nutzer online")
-        else:
-            for name, info in active_users:
-                user_display = f"{name} @ {info['ip']}:{info['tcp_port']}"
-                self.users_listbox.insert(tk.END, user_display)
+        if len(rows) == (1 if own_row else 0):
+            rows.append(((2, ''), "Keine anderen Nutzer online"))
+
+        self.apply_user_rows(rows)
+        self.rendered_version = snapshot.version
+        self.rendered_own_row = own_row
+
+    # Gleicht die Listbox mit den gewünschten Zeilen ab (beide nach Schlüssel sortiert)
+    def apply_user_rows(self, rows):
+        wanted = {key for key, _ in rows}
+
+        # 1. Zeilen entfernen, die es nicht mehr gibt (von hinten, damit die Indizes stimmen)
+        for index in range(len(self.user_rows) - 1, -1, -1):
+            if self.user_rows[index][0] not in wanted:
+                self.users_listbox.delete(index)
+                del self.user_rows[index]
+
+        # 2. Die übrigen Zeilen sind eine Teilfolge der gewünschten: neue einfügen, geänderte ersetzen
+        for index, (key, text) in enumerate(rows):
+            if index < len(self.user_rows) and self.user_rows[index][0] == key:
+                if self.user_rows[index][1] != text:
+                    selected = self.users_listbox.selection_includes(index)
+                    self.users_listbox.delete(index)
+                    self.users_listbox.insert(index, text)
+                    if selected:
+                        self.users_listbox.selection_set(index)
+                    self.user_rows[index] = (key, text)
+            else:
+                self.users_listbox.insert(index, text)
+                self.user_rows.insert(index, (key, text))
 
     # Startet eine Schleife, die alle 500 ms die aktiven Nutzer aktualisiert
     def start_user_update_loop(self):
@@ -187,33 +252,137 @@ class ChatGUI:
 
     # Startet die Nachrichten-Abfrage
     def start_message_polling(self):
+        self.poll_interval = POLL_INTERVAL_MIN
         self.poll_messages()
     
-    # Startet eine Schleife, die alle 100 ms auf neue Nachrichten prüft
+    # Holt pro Durchlauf alle wartenden Nachrichten ohne zu blockieren und fügt sie
+    # in einem Schritt ins Chat-Fenster ein. Das Intervall passt sich an:
+    # schnell solange Nachrichten kommen, bis zu POLL_INTERVAL_MAX wenn es ruhig ist.
+    # Die Neuplanung steht im finally, damit ein Fehler in einem Rückruf das Polling nicht beendet.
     def poll_messages(self):
-        msg = self.ipc_handler.get_message(timeout=0.1)
-        if msg:
-            self.display_message(msg)
-        # Wiederhole alle 100ms
-        self.root.after(100, self.poll_messages)
+        try:
+            results = self.run_ui_callbacks()
+            messages = self.ipc_handler.get_messages(max_n=500, timeout=0)
+            if messages:
+                self.append_lines([self.format_message(msg) for msg in messages])
+            if messages or results:
+                self.poll_interval = POLL_INTERVAL_MIN
+            else:
+                self.poll_interval = min(self.poll_interval * 2, POLL_INTERVAL_MAX)
+        finally:
+            self.root.after(self.poll_interval, self.poll_messages)
+
+    # Startet den Discovery-Service und fordert die aktuelle Nutzerliste an (im Hintergrund-Thread)
+    def start_discovery(self):
+        self.discovery.start()
+        self.discovery.request_discovery()
+
+    # Führt func(*args) in einem Hintergrund-Thread aus. Ist on_done angegeben, wird es
+    # anschließend mit dem Ergebnis im Tk-Thread aufgerufen (über ui_queue/poll_messages).
+    # Tk-Widgets dürfen nur im Tk-Thread angefasst werden, deshalb kein direkter Rückruf.
+    def run_in_background(self, func, *args, on_done=None):
+        def task():
+            try:
+                result = func(*args)
+            except Exception as e:
+                self.ui_queue.put((self.display_system_message, (f"Fehler im Hintergrund: {e}",)))
+                return
+            if on_done:
+                self.ui_queue.put((on_done, (result,)))
+        self.worker.submit(task)
+
+    # Ruft alle fertigen Rückmeldungen der Hintergrund-Threads auf (nur im Tk-Thread)
+    # Rückgabe: Anzahl der ausgeführten Rückrufe
+    def run_ui_callbacks(self) -> int:
+        count = 0
+        while True:
+            try:
+                callback, args = self.ui_queue.get_nowait()
+            except queue.Empty:
+                return count
+            callback(*args)
+            count += 1
 
     # Zeigt eine Nachricht im Chat-Fenster an
     def display_message(self, message):
-        msg_type  = message.get('type')
-        sender_ip = message.get('sender_ip', 'Unbekannt')
-        timestamp = message.get('timestamp', time.time())
+        self.append_lines([self.format_message(message)])
+
+    # Fügt mehrere Zeilen mit einem einzigen configure/insert/see-Durchlauf ins Chat-Fenster ein
+    # Jede Zeile landet zusätzlich im ScrollbackLog. Angezeigt werden nur die Zeilen
+    # view_start bis view_end des Verlaufs; ist die Obergrenze um eine ganze Charge
+    # überschritten, werden die ältesten Zeilen in einem Schritt entfernt.
+    def append_lines(self, lines):
+        lines = split_lines("".join(lines))
+        live = self.view_end == len(self.scrollback)
+        self.scrollback.append(lines)
+        if not live:
+            return # Es wird gerade älterer Verlauf angezeigt - neue Zeilen kommen beim Herunterscrollen
+
+        self.chat_display.configure(state='normal')
+        self.chat_display.insert(tk.END, "".join(lines))
+        self.view_end = len(self.scrollback)
+
+        excess = (self.view_end - self.view_start) - self.scrollback_lines
+        if excess >= self.scrollback_trim:
+            self.chat_display.delete("1.0", f"{excess + 1}.0")
+            self.view_start += excess
+
+        self.chat_display.see(tk.END)
+        self.chat_display.configure(state='disabled')
+
+    # yscrollcommand des Chat-Fensters: am oberen bzw. unteren Rand wird Verlauf nachgeladen
+    def on_chat_scroll(self, first, last):
+        at_top = float(first) <= 0.0 and self.view_start > 0
+        at_bottom = float(last) >= 1.0 and self.view_end < len(self.scrollback)
+        if (at_top or at_bottom) and not self.page_pending:
+            self.page_pending = True
+            self.root.after_idle(self.page_scrollback) # nicht innerhalb des Scroll-Callbacks ändern
+
+    # Lädt eine Seite (scrollback_trim Zeilen) aus dem ScrollbackLog nach und verwirft
+    # dafür am anderen Ende Zeilen, sodass höchstens scrollback_lines angezeigt werden
+    def page_scrollback(self):
+        self.page_pending = False
+        first, last = self.chat_display.yview()
+
+        # Erste sichtbare Zeile als Index im Verlauf merken, um danach wieder dorthin zu springen
+        top_line = self.view_start + int(self.chat_display.index("@0,0").split(".")[0]) - 1
+
+        self.chat_display.configure(state='normal')
+        if first <= 0.0 and self.view_start > 0:
+            lines = self.scrollback.read(self.view_start - self.scrollback_trim, self.view_start)
+            self.chat_display.insert("1.0", "".join(lines))
+            self.view_start -= len(lines)
+
+            excess = (self.view_end - self.view_start) - self.scrollback_lines
+            if excess > 0:
+                self.chat_display.delete(f"{self.scrollback_lines + 1}.0", tk.END)
+                self.view_end -= excess
+
+        elif last >= 1.0 and self.view_end < len(self.scrollback):
+            lines = self.scrollback.read(self.view_end, self.view_end + self.scrollback_trim)
+            self.chat_display.insert(tk.END, "".join(lines))
+            self.view_end += len(lines)
+
+            excess = (self.view_end - self.view_start) - self.scrollback_lines
+            if excess > 0:
+                self.chat_display.delete("1.0", f"{excess + 1}.0")
+                self.view_start += excess
+        self.chat_display.configure(state='disabled')
+
+        self.chat_display.yview(f"{max(top_line, self.view_start) - self.view_start + 1}.0")
+
+    # Baut die Anzeigezeile für eine Nachricht
+    def format_message(self, message) -> str:
+        msg_type  = message.type
+        sender_ip = message.sender_ip or 'Unbekannt'
+        timestamp = message.timestamp
         ts        = time.strftime('%H:%M:%S', time.localtime(timestamp))
 
         # ← FIX: Bessere Namensauflösung
-        sender_name = None
         local_ip = self.chat_client.config['network'].get('local_ip', '')
         
-        # Erst nach IP in der Nutzerliste suchen
-        users = self.ipc_handler.get_active_users(only_visible=False)
-        for name, info in users.items():
-            if info.get('ip') == sender_ip:
-                sender_name = name
-                break
+        # Erst nach IP in der Nutzerliste suchen (Sekundärindex im IPC-Handler)
+        sender_name = self.ipc_handler.find_user_by_ip(sender_ip)
         
         # Falls es die eigene IP ist, aber kein Name gefunden wurde
         if sender_ip == local_ip and not sender_name:
@@ -227,36 +396,28 @@ class ChatGUI:
 
         # Nachrichtentypen unterscheiden
         if msg_type == 'text':
-            content = message.get('content', '')
-            recipient = message.get('recipient', '')
+            content = message.content or ''
+            recipient = message.recipient or ''
             if recipient == self.username:
                 line = f"[{ts}] [PM] {display_name}: {content}\n"
             else:
                 line = f"[{ts}] {display_name}: {content}\n"
             
         elif msg_type == 'image':
-            fname = message.get('filename', '')
+            fname = message.filename or ''
             line = f"[{ts}] {display_name} schickte ein Bild: {fname}\n"
         elif msg_type == 'system':
-            content = message.get('content', '')
+            content = message.content or ''
             line = f"[{ts}] SYSTEM: {content}\n"
         else:
             line = f"[{ts}] Unbekannte Nachricht: {message}\n"
 
-        # Im Text-Widget einfügen
-        self.chat_display.configure(state='normal')
-        self.chat_display.insert(tk.END, line)
-        self.chat_display.see(tk.END)
-        self.chat_display.configure(state='disabled')
+        return line
 
     # Zeigt eine Systemnachricht im Chat-Fenster an
     def display_system_message(self, text):
-        self.chat_display.configure(state='normal')
         ts = time.strftime('%H:%M:%S', time.localtime())
-        line = f"[{ts}] {text}\n"
-        self.chat_display.insert(tk.END, line)
-        self.chat_display.see(tk.END)
-        self.chat_display.configure(state='disabled')
+        self.append_lines([f"[{ts}] {text}\n"])
 
     def username_abfragen(self):
         new_username = simpledialog.askstring(
@@ -299,45 +460,51 @@ class ChatGUI:
 
     # Senden-Button ()
     def send_message(self):
-        self.discovery.request_discovery() # Discovery erneut anfordern
+        self.discovery.refresh_membership() # Nutzerliste ggf. im Hintergrund auffrischen
         text = self.message_entry.get().strip()
         if not text:
             return
         
-        users = self.ipc_handler.get_active_users()
-        sent_count = 0
-        for name, info in users.items():
-            # ← FIX: Vergleiche mit self.username statt chat_client.username
-            if name != self.username:
-                try:
-                    success = self.chat_client.send_text_message(
-                        info['ip'], info['tcp_port'], name, text
-                    )
-                    if success:
-                        sent_count += 1
-                except Exception as e:
-                    print(f"Fehler beim Senden an {name}: {e}")
-        
-        # Eigene Nachricht anzeigen
-        self.display_system_message(f"Du ({self.username}): {text} (an {sent_count} Nutzer gesendet)")
+        # Dieselben Peers wie in der Nutzerliste: sichtbar und mit gültiger Lease
+        users = self.ipc_handler.get_active_users(only_visible=True)
+        # ← FIX: Vergleiche mit self.username statt chat_client.username
+        recipients = {name: info for name, info in users.items() if name != self.username}
+
+        # Parallel an alle Empfänger senden, nicht erreichbare Peers werden im Hintergrund erneut versucht.
+        # Das Ergebnis pro Empfänger zeigt show_send_report an, sobald alle Sendungen fertig sind.
+        self.run_in_background(self.outbound_queue.send_to_many, recipients, text,
+                               on_done=lambda report: self.show_send_report(text, report))
         
         # Eingabe leeren
         self.message_entry.delete(0, tk.END)
 
+    # Zeigt die eigene Nachricht und das Ergebnis pro Empfänger an (Rückruf von send_message)
+    def show_send_report(self, text, report):
+        sent_count = sum(1 for status in report.values() if status == "ok")
+        
+        # Eigene Nachricht anzeigen
+        self.display_system_message(f"Du ({self.username}): {text} (an {sent_count} Nutzer gesendet)")
+        for name, status in report.items():
+            if status in ("queued", "suspect"):
+                self.display_system_message(f"{name} nicht erreichbar - Nachricht wird später zugestellt")
+            elif status != "ok":
+                self.display_system_message(f"Senden an {name} fehlgeschlagen ({status})")
+
     # Doppelklick auf einen Nutzer in der Liste und pm
     def on_user_double_click(self, event):
         try:
             index = self.users_listbox.curselection()[0]
-            selected = self.users_listbox.get(index)
+            key = self.user_rows[index][0]
         except IndexError:
             self.display_system_message("Kein Nutzer ausgewählt.")
             return
 
-        if "@" not in selected:
+        # Nur Zeilen anderer Nutzer (Schlüssel (1, name)) können angeschrieben werden
+        if key[0] != 1:
             self.display_system_message("Kein gültiger Nutzer.")
             return
 
-        recipient = selected.split(" @ ")[0]
+        recipient = key[1]
 
         message = simpledialog.askstring(
             f"Privatnachricht an {recipient}",
@@ -347,25 +514,39 @@ class ChatGUI:
         if not message:
             return
 
-        users = self.ipc_handler.get_active_users()
-        info = users.get(recipient)
+        info = self.ipc_handler.get_user(recipient)
         if not info:
             self.display_system_message(f"{recipient} nicht erreichbar.")
             return
 
-        if self.chat_client.send_text_message(info["ip"], info["tcp_port"], recipient, message):
+        self.run_in_background(self.outbound_queue.send, recipient, info, message,
+                               on_done=lambda status: self.show_pm_status(recipient, message, status))
+
+    # Zeigt das Ergebnis einer Privatnachricht an (Rückruf von on_user_double_click)
+    def show_pm_status(self, recipient, message, status):
+        if status == "ok":
             self.display_system_message(f"[PM] Du → {recipient}: {message}")
+        elif status in ("queued", "suspect"):
+            self.display_system_message(f"[PM] Du → {recipient}: {message} (wird später zugestellt)")
+        else:
+            self.display_system_message(f"[PM] Senden an {recipient} fehlgeschlagen ({status})")
 
 
 
     #Aktualisiern-Button
     def refresh_users(self):
-        self.discovery.request_discovery()  # Discovery erneut anfordern
-        self.update_active_users()  # Nutzerliste aktualisieren
+        # Discovery erneut anfordern, danach Nutzerliste aktualisieren
+        self.run_in_background(self.discovery.request_discovery, on_done=lambda _: self.update_active_users())
 
     # Quit-Button um das Programm zu beenden
     def disconnect_from_server(self):
         self.discovery.send_leave()
+        self.worker.shutdown(wait=False, cancel_futures=True)
+        self.peer_cache.stop() # Peer-Tabelle für den nächsten Start speichern
+        self.outbound_queue.stop()
+        self.ipc_handler.stop_expiry()
+        self.chat_client.close()
+        self.scrollback.close()
         self.root.quit()
         self.root.destroy()
 
@@ -373,6 +554,9 @@ class ChatGUI:
         self.chat_display.configure(state='normal')
         self.chat_display.delete(1.0, tk.END)
         self.chat_display.configure(state='disabled')
+        # Verlauf wird mitgelöscht, sonst holt das Hochscrollen die gelöschten Zeilen zurück
+        self.scrollback.clear()
+        self.view_start = self.view_end = 0
 
 if __name__ == "__main__":
     root = tk.Tk()
@@ -1,19 +1,95 @@
+import heapq
 import queue
+from collections import deque
 import threading
 import time
-from typing import Dict, Any
+from types import MappingProxyType
+from typing import Dict, Any, List, Optional
+
+
+class PeerRecord:
+    # Eintrag eines Peers in der Nutzerliste. __slots__ statt Dictionary spart Speicher
+    # und macht Attributzugriffe schneller. Nach dem Veröffentlichen im Snapshot wird ein
+    # PeerRecord nicht mehr verändert - Änderungen erzeugen mit replace() einen neuen.
+    __slots__ = ('ip', 'tcp_port', 'status', 'last_seen', 'visible')
+
+    def __init__(self, ip: str, tcp_port: int, status: str = 'online', last_seen: float = 0.0, visible: bool = True):
+        self.ip = ip
+        self.tcp_port = tcp_port
+        self.status = status # 'online', 'suspect' oder 'unverified' (aus dem PeerCache, noch nicht bestätigt)
+        self.last_seen = last_seen
+        self.visible = visible
+
+    # Liefert eine Kopie mit geänderten Feldern
+    def replace(self, **changes) -> "PeerRecord":
+        fields = {name: getattr(self, name) for name in self.__slots__}
+        fields.update(changes)
+        return PeerRecord(**fields)
+
+    def __repr__(self):
+        return f"PeerRecord({self.ip}:{self.tcp_port}, {self.status}, last_seen={self.last_seen:.0f})"
+
+
+class ChatEvent:
+    # Ereignis, das über die message_queue an CLI bzw. GUI geht
+    # type: 'text' (content, sender_ip), 'image' (filename, sender_ip) oder 'system' (content)
+    __slots__ = ('type', 'content', 'sender_ip', 'filename', 'recipient', 'timestamp')
+
+    def __init__(self, type: str, content: str = None, sender_ip: str = None, filename: str = None,
+                 recipient: str = None, timestamp: float = None):
+        self.type = type
+        self.content = content
+        self.sender_ip = sender_ip
+        self.filename = filename
+        self.recipient = recipient
+        self.timestamp = time.time() if timestamp is None else timestamp
+
+    def __repr__(self):
+        return f"ChatEvent({self.type}, {self.content or self.filename!r}, sender_ip={self.sender_ip})"
+
+
+class UserSnapshot:
+    # Unveränderlicher, versionierter Stand der Peer-Tabelle samt Sekundärindizes.
+    # Schreiber bauen unter dem Lock einen neuen Snapshot und tauschen ihn atomar aus,
+    # Leser holen sich einfach die aktuelle Referenz - ohne Lock und ohne Kopie.
+    __slots__ = ('version', 'users', 'ip_index', 'address_index')
+
+    def __init__(self, version: int, users: Dict[str, PeerRecord], ip_index: Dict[str, frozenset], address_index: Dict[tuple, str]):
+        self.version = version
+        self.users = MappingProxyType(users) # Benutzername -> PeerRecord
+        self.ip_index = MappingProxyType(ip_index) # IP -> frozenset der Benutzernamen
+        self.address_index = MappingProxyType(address_index) # (IP, TCP-Port) -> Benutzername
 
 
 class IPCHandler:
-    def __init__(self):
+    def __init__(self, peer_timeout: float = 60, changelog_size: int = 4096):
         self.message_queue = queue.Queue() # FIFO-Warteschlange für normale Nachrichten
         self.discovery_queue = queue.Queue() # FIFO-Warteschlange für Discovery-Nachrichten
-        self.lock = threading.Lock() # Sperrt den Zugriff
-        self.active_users = {} # Leeres Dictionary das alle bekannten Peers speichert
+        self.lock = threading.Lock() # Sperrt den Zugriff für Schreiber
+        self.snapshot = UserSnapshot(0, {}, {}, {}) # Aktueller Stand aller bekannten Peers (anfangs leer)
         self.self_visible = True # Standardmäßig sichtbar - kann aber von DiscoveryService geändert werden
 
-    # Legt eine neue Chat-Nachricht (repräsentiert als Dictionary) in die interne message_queue
-    def send_message(self, message: Dict[str, Any]):
+        # Änderungsprotokoll der Nutzerliste: (Version, Benutzername) pro geändertem Eintrag.
+        # Damit können KNOWUSERS-Antworten nur die Änderungen seit der zuletzt gesendeten Version enthalten.
+        self.changelog = deque(maxlen=changelog_size)
+        # Benutzername -> Version, für Peers, die sich selbst per LEAVE abgemeldet haben. Nur diese werden
+        # in Delta-Abgleichen als LEAVE weitergegeben - abgelaufene Leases entscheidet jeder Peer selbst.
+        self.departed = {}
+
+        # Ablauf inaktiver Peers: Min-Heap mit (Ablaufzeitpunkt, Benutzername).
+        # Bei jeder Aktualisierung kommt ein neuer Eintrag dazu, veraltete Einträge
+        # werden beim Herausnehmen übersprungen. Der Expiry-Thread schläft genau
+        # bis zum nächsten Ablaufzeitpunkt statt periodisch alle Peers zu prüfen.
+        self.peer_timeout = peer_timeout
+        self.expiry_heap = []
+        self.expiry_condition = threading.Condition(self.lock)
+        self.expiry_running = False
+
+        # Wird bei jeder Änderung der Nutzerliste (neue Version) benachrichtigt, siehe wait_for_change
+        self.version_condition = threading.Condition(self.lock)
+
+    # Legt eine neue Chat-Nachricht (repräsentiert als ChatEvent) in die interne message_queue
+    def send_message(self, message: ChatEvent):
         self.message_queue.put(message)
 
     # Holt die nächste Chat-Nachricht aus der Warteschlange, wenn vorhanden
@@ -23,6 +99,21 @@ class IPCHandler:
         except queue.Empty:
             return None  # Gibt None zurück, wenn die Warteschlange leer ist
 
+    # Wartet höchstens timeout Sekunden auf die erste Nachricht und holt dann alle
+    # bereits wartenden Nachrichten (maximal max_n) ohne weiteres Warten ab.
+    # Kehrt sofort zurück, sobald etwas da ist - gibt eine leere Liste zurück, wenn nicht.
+    def get_messages(self, max_n=100, timeout=1) -> List[ChatEvent]:
+        try:
+            messages = [self.message_queue.get(timeout=timeout)]
+        except queue.Empty:
+            return []
+        while len(messages) < max_n:
+            try:
+                messages.append(self.message_queue.get_nowait())
+            except queue.Empty:
+                break
+        return messages
+
     # user_info wird in discovery_queue geschickt
     # Funktionsweise aehnlich wie send_message aber fuer Discovery-Updates 
     def send_discovery_update(self, user_info: Dict[str, Any]):
@@ -37,27 +128,210 @@ class IPCHandler:
 
     # Aktualisiert die Liste der aktiven Benutzer
     def update_user_list(self, username: str, ip_address: str, tcp_port: int, timestamp: float = None):
-        if not username.strip():  # LEERE ODER UNGÜLTIGE NAMEN IGNORIEREN
-            return
+        self.update_users([(username, ip_address, tcp_port)], timestamp)
+
+    # Aktualisiert mehrere Benutzer (Liste von (Benutzername, IP, TCP-Port)) mit höchstens zwei neuen
+    # Snapshots statt einem pro Eintrag - z.B. für eine ganze KNOWUSERS-Zeile
+    def update_users(self, entries, timestamp: float = None):
+        if timestamp is None:
+            timestamp = time.time()
+        with self.lock:
+            changed = {}
+            refreshed = {}
+            for username, ip_address, tcp_port in entries:
+                if not username.strip():  # LEERE ODER UNGÜLTIGE NAMEN IGNORIEREN
+                    continue
+                # Ein als "suspect" markierter Peer bleibt es, bis wieder eine Zustellung klappt.
+                # Ein "unverified" Peer aus dem PeerCache ist mit diesem Lebenszeichen bestätigt.
+                status = 'online'
+                old = self.snapshot.users.get(username)
+                if old and old.ip == ip_address and old.tcp_port == tcp_port and old.status == 'suspect':
+                    status = 'suspect'
+
+                info = PeerRecord(ip_address, tcp_port, status, timestamp)
+                # Reine Auffrischung von last_seen zählt nicht als Änderung der Nutzerliste
+                refresh_only = (old is not None and old.ip == ip_address and old.tcp_port == tcp_port and old.visible
+                                and old.status == status)
+                if refresh_only:
+                    refreshed[username] = info
+                else:
+                    changed[username] = info
+            if changed:
+                self.commit(changed)
+            if refreshed:
+                self.commit(refreshed, changed=False)
+
+            # Neuen Ablaufzeitpunkt eintragen und den Expiry-Thread wecken, falls er jetzt früher fällig ist
+            deadline = timestamp + self.peer_timeout
+            earliest = self.expiry_heap[0] if self.expiry_heap else None
+            for username in list(changed) + list(refreshed):
+                heapq.heappush(self.expiry_heap, (deadline, username))
+            if self.expiry_heap and self.expiry_heap[0] != earliest:
+                self.expiry_condition.notify()
+
+    # Trägt Peers aus dem PeerCache (Liste von (Benutzername, IP, TCP-Port)) in einem Snapshot als
+    # "unverified" ein - nur solche, die noch nicht bekannt sind. Rückgabe: eingetragene Benutzernamen
+    def add_unverified_users(self, entries, timestamp: float = None) -> list:
+        if timestamp is None:
+            timestamp = time.time()
+        with self.lock:
+            updates = {}
+            for username, ip_address, tcp_port in entries:
+                if username.strip() and username not in self.snapshot.users:
+                    updates[username] = PeerRecord(ip_address, tcp_port, 'unverified', timestamp)
+            if not updates:
+                return []
+            self.commit(updates)
+            deadline = timestamp + self.peer_timeout
+            for username in updates:
+                heapq.heappush(self.expiry_heap, (deadline, username))
+            self.expiry_condition.notify()
+            return list(updates)
+
+    # Frischt last_seen mehrerer Peers in einem einzigen Snapshot auf, z.B. wenn die Gossip-Fehlererkennung
+    # sie als lebendig bestätigt. Zählt wie update_user_list nicht als Änderung der Nutzerliste.
+    def touch_users(self, usernames, timestamp: float = None):
         if timestamp is None:
             timestamp = time.time()
         with self.lock:
-            self.active_users[username] = { # Ein Dictionary, in dem jeder Schlüssel ein Benutzername ist
-                'ip': ip_address,
-                'tcp_port': tcp_port,
-                'status': 'online',
-                'last_seen': timestamp,
-                'visible': True
-            }
+            updates = {}
+            for username in usernames:
+                info = self.snapshot.users.get(username)
+                if info is not None:
+                    updates[username] = info.replace(last_seen=timestamp)
+            if not updates:
+                return
+            self.commit(updates, changed=False)
+            deadline = timestamp + self.peer_timeout
+            for username in updates:
+                heapq.heappush(self.expiry_heap, (deadline, username))
+
+    #Interne Methode: Veröffentlicht einen neuen Snapshot mit den geänderten Einträgen (nur mit self.lock aufrufen)
+    # updates: Benutzername -> neue Infos oder None zum Entfernen
+    # Der alte Snapshot bleibt unverändert, Leser die ihn gerade benutzen sehen einen konsistenten Stand.
+    def commit(self, updates: Dict[str, Optional[PeerRecord]], changed: bool = True):
+        old = self.snapshot
+        users = dict(old.users)
+        ip_index = dict(old.ip_index)
+        address_index = dict(old.address_index)
+
+        for username, info in updates.items():
+            self.departed.pop(username, None) # jede weitere Änderung ersetzt ein früheres LEAVE
+            previous = users.pop(username, None)
+            if previous is not None:
+                handles = ip_index[previous.ip] - {username}
+                if handles:
+                    ip_index[previous.ip] = handles
+                else:
+                    del ip_index[previous.ip]
+                address = (previous.ip, previous.tcp_port)
+                if address_index.get(address) == username:
+                    del address_index[address]
+
+            if info is not None:
+                users[username] = info
+                ip_index[info.ip] = ip_index.get(info.ip, frozenset()) | {username}
+                address_index[(info.ip, info.tcp_port)] = username
+
+        version = old.version + 1 if changed else old.version
+        if changed:
+            for username in updates:
+                self.changelog.append((version, username))
+        self.snapshot = UserSnapshot(version, users, ip_index, address_index)
+        if changed:
+            self.version_condition.notify_all()
+
+    # Liefert den aktuellen, unveränderlichen Snapshot der Peer-Tabelle - ohne Lock und ohne Kopie
+    def get_snapshot(self) -> "UserSnapshot":
+        return self.snapshot
+
+    # Versionsnummer der Nutzerliste, steigt bei jeder Änderung (außer reinem Auffrischen von last_seen)
+    def get_version(self) -> int:
+        return self.snapshot.version
+
+    # Liefert (aktuelle Version, Benutzernamen, die seit version hinzugekommen, geändert oder entfernt wurden).
+    # Reicht das Änderungsprotokoll nicht bis version zurück, ist die Menge None - dann ist ein
+    # vollständiger Abgleich nötig.
+    def changes_since(self, version: int):
+        with self.lock:
+            current = self.snapshot.version
+            if version >= current:
+                return current, set()
+            # Nur wenn noch ein Eintrag mit Version <= version existiert, fehlt nichts dazwischen
+            if not self.changelog or self.changelog[0][0] > version:
+                return current, None
+            changed = set()
+            for entry_version, username in reversed(self.changelog):
+                if entry_version <= version:
+                    break
+                changed.add(username)
+            return current, changed
+
+    # Welche der Benutzernamen sind per LEAVE abgemeldet und seitdem nicht zurückgekehrt
+    def departed_among(self, usernames) -> set:
+        with self.lock:
+            return {u for u in usernames if u in self.departed and u not in self.snapshot.users}
+
+    # Wartet, bis sich die Nutzerliste gegenüber version geändert hat und danach quiet Sekunden lang
+    # keine weitere Änderung kommt (z.B. mehrere KNOWUSERS-Antworten auf ein WHO), höchstens timeout Sekunden.
+    # Rückgabe: aktuelle Version
+    def wait_for_change(self, version: int, timeout: float, quiet: float = 0.2) -> int:
+        deadline = time.monotonic() + timeout
+        with self.version_condition:
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                if self.snapshot.version == version:
+                    self.version_condition.wait(remaining)
+                    continue
+                version = self.snapshot.version
+                self.version_condition.wait(min(quiet, remaining))
+                if self.snapshot.version == version:
+                    break
+            return self.snapshot.version
+
+    # Liefert die Infos zu einem Peer oder None - ohne die ganze Tabelle zu kopieren
+    def get_user(self, username: str):
+        return self.snapshot.users.get(username)
+
+    # Liefert einen Benutzernamen zu einer IP-Adresse oder None (O(1) über den Sekundärindex)
+    def find_user_by_ip(self, ip_address: str):
+        handles = self.snapshot.ip_index.get(ip_address)
+        return next(iter(handles)) if handles else None
+
+    # Liefert alle Benutzernamen, die unter einer IP-Adresse bekannt sind
+    def get_users_by_ip(self, ip_address: str):
+        return tuple(self.snapshot.ip_index.get(ip_address, ()))
+
+    # Liefert den Benutzernamen zu (IP, TCP-Port) oder None
+    def find_user_by_address(self, ip_address: str, tcp_port: int):
+        return self.snapshot.address_index.get((ip_address, tcp_port))
+
+    # Setzt den Zustand eines Peers ('online' oder 'suspect'), z.B. durch den Circuit Breaker der OutboundQueue
+    def set_user_status(self, username: str, status: str):
+        with self.lock:
+            info = self.snapshot.users.get(username)
+            if info is not None and info.status != status:
+                self.commit({username: info.replace(status=status)})
+
+    # Einheitliche Definition von "lebendig" für IPCHandler, CLI und GUI: ein Peer hält eine Lease von
+    # peer_timeout Sekunden, die jedes Lebenszeichen (JOIN/Heartbeat, KNOWUSERS, Gossip) erneuert
+    def is_alive(self, info: PeerRecord, now: float = None) -> bool:
+        if now is None:
+            now = time.time()
+        return info.last_seen + self.peer_timeout > now
 
     # Liefert eine Kopie des aktuellen Peer-Dictionaries zurück, optional nur die, deren visible == True ist (Standard)
+    # Peers mit abgelaufener Lease fehlen, auch wenn der Expiry-Thread sie noch nicht entfernt hat.
+    # Wer nur liest, sollte get_snapshot() verwenden - das kommt ohne Kopie aus
     def get_active_users(self, only_visible=True):
-        with self.lock:
-            result = {}
-            for name, info in self.active_users.items():
-                if not only_visible or info.get('visible', True):
-                    result[name] = info
-            return result
+        now = time.time()
+        result = {}
+        for name, info in self.snapshot.users.items():
+            if (not only_visible or info.visible) and self.is_alive(info, now):
+                result[name] = info
+        return result
 
     def set_visibility(self, visible: bool):
         with self.lock:
@@ -67,24 +341,72 @@ class IPCHandler:
         with self.lock:
             return self.self_visible
 
-    #Interne Methode: Löscht einen Nutzer-Eintrag aus active_users und sperrt das Dictionary mit self.lock
+    #Interne Methode: Löscht einen Nutzer-Eintrag aus der Peer-Tabelle und sperrt sie dabei mit self.lock
     def remove_user(self, username: str):
         with self.lock:
-            if username in self.active_users:
-                del self.active_users[username]
+            if username in self.snapshot.users:
+                self.commit({username: None})
     
     #Öffentliche Schnittstelle für DiscoveryService und andere Aufrufer.
-    #Leitet weiter an die interne remove_user()-Methode.
+    #Entfernt einen Benutzer, der sich per LEAVE abgemeldet hat, und merkt sich das für den Delta-Abgleich.
     def remove_user_by_name(self, username: str):
-        self.remove_user(username)
+        with self.lock:
+            if username not in self.snapshot.users:
+                return
+            self.commit({username: None})
+            self.departed[username] = self.snapshot.version
+            # Ältere Einträge als das Änderungsprotokoll braucht kein Delta mehr
+            oldest = self.changelog[0][0]
+            for name in [name for name, version in self.departed.items() if version < oldest]:
+                del self.departed[name]
 
-    # Entfernt alle Benutzer, die seit längerem inaktiv sind
-    def cleanup_inactive_users(self, timeout=60):
+    # Entfernt alle Benutzer, deren Lease abgelaufen ist (timeout: abweichende Lease-Dauer, Standard peer_timeout)
+    def cleanup_inactive_users(self, timeout=None):
         current_time = time.time()
+        if timeout is None:
+            timeout = self.peer_timeout
         with self.lock:
-            to_remove = []
-            for username, info in self.active_users.items():
-                if current_time - info['last_seen'] > timeout:
-                    to_remove.append(username)
-            for name in to_remove:
-                del self.active_users[name]
\ No newline at end of file
+            to_remove = {}
+            for username, info in self.snapshot.users.items():
+                if current_time - info.last_seen >= timeout:
+                    to_remove[username] = None
+            if to_remove:
+                self.commit(to_remove)
+
+    # Startet den Expiry-Thread, der Peers genau bei Ablauf ihrer peer_timeout entfernt
+    def start_expiry(self):
+        with self.lock:
+            if self.expiry_running:
+                return
+            self.expiry_running = True
+        threading.Thread(target=self.expiry_loop, daemon=True).start()
+
+    # Stoppt den Expiry-Thread
+    def stop_expiry(self):
+        with self.expiry_condition:
+            self.expiry_running = False
+            self.expiry_condition.notify()
+
+    # Entfernt abgelaufene Peers und meldet sie über die message_queue an CLI/GUI
+    def expiry_loop(self):
+        with self.expiry_condition:
+            while self.expiry_running:
+                now = time.time()
+                expired = {}
+                while self.expiry_heap and self.expiry_heap[0][0] <= now:
+                    _, username = heapq.heappop(self.expiry_heap)
+                    info = self.snapshot.users.get(username)
+
+                    # Veralteter Heap-Eintrag: Peer schon entfernt oder inzwischen wieder gesehen
+                    if info is None or self.is_alive(info, now):
+                        continue
+                    expired[username] = None
+
+                if expired:
+                    self.commit(expired)
+                    for username in expired:
+                        self.message_queue.put(ChatEvent('system', f"{username} ist nicht mehr erreichbar (Timeout).", timestamp=now))
+
+                # Bis zum nächsten Ablaufzeitpunkt schlafen (oder bis ein früherer eingetragen wird)
+                timeout = self.expiry_heap[0][0] - now if self.expiry_heap else None
+                self.expiry_condition.wait(timeout)
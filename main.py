@@ -1,16 +1,16 @@
 import sys
 import argparse
-import time
 import signal
-import threading
 import os
 import socket
 import toml
 
 from ipc_handler import IPCHandler
 from discovery import DiscoveryService
-from chat_server import ChatServer
+from chat_server import create_chat_server
 from chat_client import ChatClient
+from outbound_queue import OutboundQueue
+from peer_cache import PeerCache
 from cli import CLI 
 
 
@@ -24,15 +24,17 @@ class SimpleChatApp:
         # Lokale IP ermitteln und in Config speichern
         self.config['network']['local_ip'] = self.get_local_ip()
 
-        self.ipc_handler = IPCHandler()
-        self.chat_server = ChatServer(self.config, self.ipc_handler)
+        self.ipc_handler = IPCHandler(self.config['network'].get('peer_timeout', 60))
+        self.chat_server = create_chat_server(self.config, self.ipc_handler)
         self.chat_server.start()
 
         chat_port = self.chat_server.config["network"]["chat_port"]
 
         self.discovery = DiscoveryService(self.config, self.ipc_handler, self.username, chat_port)
         self.chat_client = ChatClient(self.config, self.username)
-        self.cli = CLI(self.config, self.ipc_handler, self.chat_client, self.discovery)
+        self.outbound_queue = OutboundQueue(self.config, self.chat_client, self.ipc_handler)
+        self.peer_cache = PeerCache(self.config, self.ipc_handler, self.chat_client)
+        self.cli = CLI(self.config, self.ipc_handler, self.chat_client, self.discovery, self.outbound_queue)
 
         self.running = False
         signal.signal(signal.SIGINT, self.signal_handler)
@@ -70,25 +72,17 @@ class SimpleChatApp:
     # Startet die Anwendung und initialisiert den Chat-Server und Discovery-Service
     def start(self):
         self.running = True
+        self.peer_cache.start() # Zuletzt bekannte Peers laden und im Hintergrund prüfen
         self.discovery.start() # Startet den Discovery-Service
 
         print(f"[SLCP] Starte Peer-to-Peer Chat...")
         print(f"[Server] Lauscht auf TCP-Port {self.config['network']['chat_port']}")
         print(f"[Hinweis] Tippe /join <name>, um dem Chat beizutreten.\n")
 
-        threading.Thread(target=self.cleanup_loop, daemon=True).start()
+        self.ipc_handler.start_expiry() # Inaktive Nutzer genau bei Ablauf ihres Timeouts entfernen
         self.cli.start() # Startet die CLI
         #self.shutdown() #unnoetig?!
 
-    # Periodisch inaktiv Nutzer entfernen
-    def cleanup_loop(self):
-        while self.running:
-            try:
-                self.ipc_handler.cleanup_inactive_users(60)
-                time.sleep(30) # Warte 30 Sekunden vor der nächsten Bereinigung
-            except Exception:
-                pass
-
     # Beendet die Anwendung, stoppt den Chat-Server und Discovery-Service
     def shutdown(self):
         print("\nChat wird beendet...")
@@ -96,6 +90,10 @@ class SimpleChatApp:
         self.cli.stop()
         self.chat_server.stop()
         self.discovery.stop()
+        self.peer_cache.stop() # Peer-Tabelle für den nächsten Start speichern
+        self.outbound_queue.stop()
+        self.ipc_handler.stop_expiry()
+        self.chat_client.close()
         print("Anwendung beendet.")
 
     # Signal-Handler für STRG+C --> sauberes beenden der Anwendung
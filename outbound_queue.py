@@ -0,0 +1,148 @@
+import threading
+from collections import deque
+from typing import Dict, Any
+
+from ipc_handler import ChatEvent, PeerRecord
+
+
+class OutboundQueue:
+    # Ausgehende Nachrichten, die nicht sofort zugestellt werden konnten, landen pro Peer
+    # in einer Warteschlange und werden im Hintergrund mit exponentiellem Backoff erneut gesendet.
+    # Nach suspect_after_failures Fehlversuchen in Folge gilt ein Peer als "suspect" (Circuit Breaker):
+    # Nachrichten an ihn blockieren den Absender dann nicht mehr, sondern werden direkt eingereiht
+    # und erst nach einem kurzen Verbindungstest (probe_timeout) zugestellt.
+    def __init__(self, config: Dict[str, Any], chat_client, ipc_handler):
+        network = config.get('network', {})
+        self.chat_client = chat_client
+        self.ipc_handler = ipc_handler
+        self.max_retries = network.get('send_max_retries', 5)
+        self.backoff_base = network.get('send_backoff_base', 1)
+        self.backoff_max = network.get('send_backoff_max', 30)
+        self.failure_threshold = network.get('suspect_after_failures', 3)
+        self.probe_timeout = network.get('probe_timeout', 0.5)
+
+        self.lock = threading.Lock()
+        self.pending = {} # handle -> deque mit noch nicht zugestellten Nachrichten
+        self.failures = {} # handle -> Anzahl Fehlversuche in Folge
+        self.workers = set() # handles, für die gerade ein Worker-Thread läuft
+        self.stop_event = threading.Event()
+
+    # Beendet alle Worker (noch nicht zugestellte Nachrichten werden verworfen)
+    def stop(self):
+        self.stop_event.set()
+
+    # Prüft, ob der Circuit Breaker für einen Peer offen ist
+    def is_suspect(self, handle: str) -> bool:
+        with self.lock:
+            return self.failures.get(handle, 0) >= self.failure_threshold
+
+    # Merkt sich eine erfolgreiche Zustellung und setzt den Peer ggf. wieder auf "online"
+    def record_success(self, handle: str):
+        with self.lock:
+            was_suspect = self.failures.pop(handle, 0) >= self.failure_threshold
+        if was_suspect:
+            self.ipc_handler.set_user_status(handle, 'online')
+            self.ipc_handler.send_message(ChatEvent('system', f"{handle} ist wieder erreichbar."))
+
+    # Zählt einen Fehlversuch und markiert den Peer beim Erreichen der Schwelle als "suspect"
+    def record_failure(self, handle: str):
+        with self.lock:
+            count = self.failures.get(handle, 0) + 1
+            self.failures[handle] = count
+        if count == self.failure_threshold:
+            self.ipc_handler.set_user_status(handle, 'suspect')
+            self.ipc_handler.send_message(ChatEvent('system', f"{handle} reagiert nicht - Nachrichten werden zurückgehalten."))
+
+    # Reiht eine Nachricht für einen Peer ein und startet bei Bedarf dessen Worker
+    def enqueue(self, handle: str, message: str):
+        with self.lock:
+            self.pending.setdefault(handle, deque()).append(message)
+            if handle in self.workers:
+                return
+            self.workers.add(handle)
+        threading.Thread(target=self.worker, args=(handle,), daemon=True).start()
+
+    # Sendet eine Nachricht an einen einzelnen Peer, ohne bei einem "suspect"-Peer zu blockieren
+    # Rückgabe: "ok", "queued" (wird im Hintergrund erneut versucht), "suspect" oder "invalid"
+    def send(self, handle: str, info: PeerRecord, message: str) -> str:
+        return self.send_to_many({handle: info}, message)[handle]
+
+    # Wie ChatClient.send_text_to_many, aber mit Circuit Breaker und Wiederholung im Hintergrund
+    def send_to_many(self, recipients: Dict[str, PeerRecord], message: str) -> Dict[str, str]:
+        report = {}
+        healthy = {}
+        for handle, info in recipients.items():
+            if self.is_suspect(handle):
+                self.enqueue(handle, message) # Zustellung nach erfolgreichem Verbindungstest
+                report[handle] = "suspect"
+            else:
+                healthy[handle] = info
+
+        for handle, status in self.chat_client.send_text_to_many(healthy, message).items():
+            if status == "ok":
+                self.record_success(handle)
+            elif status != "invalid":
+                self.record_failure(handle)
+                self.enqueue(handle, message)
+                status = "queued"
+            report[handle] = status
+        return report
+
+    # Kurzer Verbindungstest mit probe_timeout. Die Verbindung bleibt im Pool
+    # und wird vom anschließenden Senden direkt wiederverwendet.
+    def probe(self, info: PeerRecord) -> bool:
+        try:
+            self.chat_client.pool.run(info.ip, info.tcp_port, lambda sock: None, timeout=self.probe_timeout)
+            return True
+        except OSError:
+            return False
+
+    # Worker-Thread pro Peer: stellt die Warteschlange zu, solange sie nicht leer ist
+    def worker(self, handle: str):
+        attempt = 0
+        while not self.stop_event.is_set():
+            with self.lock:
+                queued = self.pending.get(handle)
+                if not queued:
+                    self.pending.pop(handle, None)
+                    self.workers.discard(handle)
+                    return
+                messages = list(queued)
+
+            info = self.ipc_handler.get_user(handle)
+            if info is None:
+                # Peer ist nicht mehr bekannt (LEAVE oder Timeout)
+                self.drop(handle, len(messages))
+                continue
+
+            if self.is_suspect(handle) and not self.probe(info):
+                delivered = False
+            else:
+                # Alle wartenden Nachrichten gebündelt über eine Verbindung senden
+                delivered = self.chat_client.send_batch(info.ip, info.tcp_port, [(handle, m) for m in messages])
+
+            if delivered:
+                with self.lock:
+                    for _ in messages:
+                        queued.popleft()
+                self.record_success(handle)
+                attempt = 0
+                continue
+
+            self.record_failure(handle)
+            attempt += 1
+            if attempt > self.max_retries:
+                self.drop(handle, len(messages))
+                attempt = 0
+                continue
+
+            # Exponentielles Backoff: 1s, 2s, 4s, ... bis backoff_max
+            self.stop_event.wait(min(self.backoff_max, self.backoff_base * 2 ** (attempt - 1)))
+
+    # Verwirft die ersten count wartenden Nachrichten eines Peers und meldet das der Anzeige
+    def drop(self, handle: str, count: int):
+        with self.lock:
+            queued = self.pending.get(handle, deque())
+            for _ in range(min(count, len(queued))):
+                queued.popleft()
+        self.ipc_handler.send_message(ChatEvent('system', f"{count} Nachricht(en) an {handle} konnten nicht zugestellt werden."))
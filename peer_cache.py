@@ -0,0 +1,111 @@
+import json
+import os
+import threading
+import time
+from concurrent.futures import wait
+from typing import Dict, Any
+
+
+class PeerCache:
+    # Speichert die zuletzt bekannte Peer-Tabelle in einer kleinen JSON-Datei (peer_cache_file), damit nach
+    # einem Neustart nicht erst Broadcasts und ein WHO abgewartet werden müssen. Beim Start werden die Einträge
+    # als "unverified" geladen und im Hintergrund parallel per kurzem Verbindungsaufbau geprüft: erreichbare
+    # Peers werden "online" (die Verbindung bleibt im Pool für die erste Nachricht), die anderen entfernt.
+    # Gespeichert wird alle peer_cache_interval Sekunden und beim Beenden.
+    #
+    # Dateiformat: {"saved": <Zeitpunkt>, "peers": {"<handle>": ["<ip>", <tcp_port>, <last_seen>], ...}}
+    def __init__(self, config: Dict[str, Any], ipc_handler, chat_client):
+        system = config.get('system', {})
+        network = config.get('network', {})
+        self.config = config
+        self.ipc_handler = ipc_handler
+        self.chat_client = chat_client
+        self.path = system.get('peer_cache_file', 'peers_cache.json')
+        self.save_interval = system.get('peer_cache_interval', 30)
+        self.max_age = system.get('peer_cache_max_age', 3600) # ältere Einträge werden nicht geladen
+        self.probe_timeout = network.get('probe_timeout', 0.5)
+        self.stop_event = threading.Event()
+
+    # Lädt den Cache und startet Prüfung und periodisches Speichern im Hintergrund
+    def start(self):
+        loaded = self.load()
+        if loaded:
+            threading.Thread(target=self.verify, args=(loaded,), daemon=True).start()
+        threading.Thread(target=self.save_loop, daemon=True).start()
+
+    # Beendet das periodische Speichern und speichert ein letztes Mal
+    def stop(self):
+        self.stop_event.set()
+        self.save()
+
+    # Trägt die gespeicherten Peers als "unverified" mit last_seen = jetzt ein
+    # Rückgabe: Liste der geladenen Benutzernamen
+    def load(self) -> list:
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return []
+        except (OSError, ValueError) as e:
+            print(f"[PeerCache] Cache {self.path} nicht lesbar: {e}")
+            return []
+
+        now = time.time()
+        own_address = (self.config['network'].get('local_ip'), self.config['network'].get('chat_port'))
+        entries = []
+        for handle, entry in data.get('peers', {}).items():
+            try:
+                ip, tcp_port, last_seen = entry[0], int(entry[1]), float(entry[2])
+            except (TypeError, ValueError, IndexError):
+                continue
+            if now - last_seen > self.max_age or (ip, tcp_port) == own_address or handle == self.chat_client.username:
+                continue
+            entries.append((handle, ip, tcp_port))
+        # Ein Snapshot für alle, schon per Discovery bekannte Peers bleiben unverändert
+        loaded = self.ipc_handler.add_unverified_users(entries, now)
+        if loaded:
+            print(f"[PeerCache] {len(loaded)} Peer(s) aus {self.path} geladen, Prüfung läuft...")
+        return loaded
+
+    # Prüft die geladenen Peers parallel über den Fan-out-Pool des ChatClients
+    def verify(self, handles: list):
+        def probe(handle: str) -> bool:
+            info = self.ipc_handler.get_user(handle)
+            if info is None or info.status != 'unverified':
+                return True # inzwischen entfernt oder anders bestätigt
+            try:
+                # Verbindung bleibt im Pool und wird von der ersten Nachricht wiederverwendet
+                self.chat_client.pool.run(info.ip, info.tcp_port, lambda sock: None, timeout=self.probe_timeout)
+            except OSError:
+                return False
+            self.ipc_handler.update_user_list(handle, info.ip, info.tcp_port, time.time())
+            self.ipc_handler.set_user_status(handle, 'online')
+            return True
+
+        futures = {self.chat_client.executor.submit(probe, handle): handle for handle in handles}
+        wait(futures)
+        for future, handle in futures.items():
+            if future.exception() is None and future.result():
+                continue
+            # Nicht erreichbar - nur entfernen, wenn er nicht inzwischen anderweitig gesehen wurde
+            info = self.ipc_handler.get_user(handle)
+            if info is not None and info.status == 'unverified':
+                self.ipc_handler.remove_user(handle)
+
+    # Schreibt alle bestätigten Peers in die Cache-Datei (über eine temporäre Datei, damit sie nie halb geschrieben ist)
+    def save(self):
+        peers = {}
+        for handle, info in self.ipc_handler.get_snapshot().users.items():
+            if info.status != 'unverified' and handle != self.chat_client.username:
+                peers[handle] = [info.ip, info.tcp_port, round(info.last_seen, 1)]
+        tmp_path = self.path + ".tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({"saved": round(time.time(), 1), "peers": peers}, f, separators=(',', ':'))
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            print(f"[PeerCache] Cache {self.path} konnte nicht gespeichert werden: {e}")
+
+    def save_loop(self):
+        while not self.stop_event.wait(self.save_interval):
+            self.save()
@@ -0,0 +1,61 @@
+import tempfile
+from array import array
+from typing import List
+
+
+# Teilt Text nur an "\n" in Zeilen (mit abschließendem "\n"). str.splitlines trennt auch an "\r",
+# "\x0b", "\u2028" usw., Tk zählt aber nur "\n" als Zeilenende - sonst stimmen die Zeilennummern nicht.
+def split_lines(text: str) -> List[str]:
+    lines = [line + "\n" for line in text.split("\n")]
+    lines[-1] = lines[-1][:-1]
+    if not lines[-1]:
+        lines.pop()
+    return lines
+
+
+class ScrollbackLog:
+    # Verlauf des Chat-Fensters auf der Festplatte.
+    # Jede angezeigte Zeile wird angehängt, im Speicher bleibt pro Zeile nur ihre
+    # Startposition in der Datei (8 Byte). So kann das Chat-Fenster alte Zeilen
+    # verwerfen und bei Bedarf seitenweise wieder nachladen.
+    def __init__(self, path: str = None):
+        # Ohne Pfad: temporäre Datei, die beim Beenden automatisch gelöscht wird
+        self.file = open(path, "w+b") if path else tempfile.TemporaryFile()
+        self.offsets = array('q') # Startposition jeder Zeile in der Datei
+        self.size = 0 # Aktuelles Dateiende
+
+    # Anzahl der gespeicherten Zeilen
+    def __len__(self):
+        return len(self.offsets)
+
+    # Hängt Zeilen (jeweils mit abschließendem "\n") an den Verlauf an
+    def append(self, lines: List[str]):
+        data = []
+        for line in lines:
+            encoded = line.encode("utf-8")
+            self.offsets.append(self.size)
+            self.size += len(encoded)
+            data.append(encoded)
+        self.file.seek(0, 2)
+        self.file.write(b"".join(data))
+
+    # Liest die Zeilen start bis stop (exklusiv) aus der Datei
+    def read(self, start: int, stop: int) -> List[str]:
+        start = max(0, start)
+        stop = min(stop, len(self.offsets))
+        if start >= stop:
+            return []
+        begin = self.offsets[start]
+        end = self.offsets[stop] if stop < len(self.offsets) else self.size
+        self.file.seek(begin)
+        return split_lines(self.file.read(end - begin).decode("utf-8"))
+
+    # Verwirft den gesamten Verlauf (Datei und Zeilenindex)
+    def clear(self):
+        self.file.seek(0)
+        self.file.truncate()
+        self.offsets = array('q')
+        self.size = 0
+
+    def close(self):
+        self.file.close()